@@ -4,7 +4,10 @@ echo "#!/usr/bin/env python2" > satori-problems
 pushd src
 find -name "*.pyc" -type f -exec rm {} +
 find -name "__pycache__" -type d -exec rmdir {} +
+# bytecode is shipped, so that the bundle does not compile itself on every run
+python2 -m compileall -q .
 zip -r9 ../src.zip *
+find -name "*.pyc" -type f -exec rm {} +
 popd
 cat src.zip >> satori-problems
 rm src.zip
@@ -16,6 +19,7 @@ cp -a src/* build-warsztaty/
 cp -a warsztaty/* build-warsztaty/
 echo "#!/usr/bin/env python2" > satori-problems-warsztaty
 pushd build-warsztaty
+python2 -m compileall -q .
 zip -r9 ../src.zip *
 popd
 rm -rf build-warsztaty
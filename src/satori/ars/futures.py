@@ -0,0 +1,84 @@
+# vim:ts=4:sts=4:sw=4:expandtab
+
+import sys
+import threading
+import time
+
+import six
+
+__all__ = [ 'Future' ]
+
+
+class Future(object):
+    """The result of a computation finished by another thread."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = [ ]
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info=None):
+        self._finish(None, exc_info or sys.exc_info())
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            if self._callbacks is None:
+                raise RuntimeError("Future is already finished")
+            self._result = result
+            self._exc_info = exc_info
+            callbacks = self._callbacks
+            self._callbacks = None
+            self._event.set()
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once finished, immediately if it already is."""
+        with self._lock:
+            if self._callbacks is not None:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        # waiting in short steps keeps the main thread interruptible on Python 2
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._event.wait(1 if deadline is None else max(0, min(1, deadline - time.time()))):
+            if deadline is not None and time.time() >= deadline:
+                raise RuntimeError("Timed out waiting for a result")
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
+        return self._result
+
+    def chain(self, other):
+        """Finish this future with the outcome of other."""
+        def copy(other):
+            if other._exc_info is not None:
+                self._finish(None, other._exc_info)
+            else:
+                self._finish(other._result, None)
+        other.add_done_callback(copy)
+
+    def then(self, function):
+        """Return a Future of function applied to the result of this one."""
+        future = Future()
+        def apply(self):
+            if self._exc_info is not None:
+                future._finish(None, self._exc_info)
+                return
+            try:
+                result = function(self._result)
+            except:
+                future.set_exception()
+            else:
+                future.set_result(result)
+        self.add_done_callback(apply)
+        return future
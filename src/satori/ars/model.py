@@ -387,6 +387,10 @@ class ArsProcedure(ArsNamedElement):
         super(ArsProcedure, self).__init__(name)
         self.return_type = return_type
         self.implementation = implementation
+        # returns a Future of the result, when provided by a client
+        self.async_implementation = None
+        # makes many calls at once, when provided by a client
+        self.batch_implementation = None
         self.parameters = ArsNamedTuple()
         self.exception_types = []
 
@@ -8,5 +8,6 @@ from satori.ars.thrift.reader import ThriftReader
 from satori.ars.thrift.writer import ThriftWriter
 from satori.ars.thrift.client import ThriftClient
 from satori.ars.thrift.client import ThriftHttpClient
+from satori.ars.thrift.client import ThriftAsyncClient
 from satori.ars.thrift.server import ThriftServer
 
@@ -0,0 +1,142 @@
+# vim:ts=4:sts=4:sw=4:expandtab
+"""Measures the speed of encoding and decoding typical Satori payloads.
+
+Run with: python -m satori.ars.thrift.benchmark [repeat]
+"""
+
+from __future__ import absolute_import, print_function
+
+import sys
+import timeit
+
+from thrift.Thrift import TMessageType, TType
+from thrift.transport.TTransport import TFramedTransport, TMemoryBuffer
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+
+from satori.ars.model import *
+from satori.ars.thrift.codec import buffer_reader
+from satori.ars.thrift.processor import ThriftProcessor
+
+
+def _make_interface():
+    attribute = ArsStructure(name='AnonymousAttribute')
+    attribute.add_field(name='is_blob', type=ArsBoolean)
+    attribute.add_field(name='value', type=ArsString)
+    attribute.add_field(name='filename', type=ArsString, optional=True)
+    test = ArsStructure(name='TestStruct')
+    test.add_field(name='id', type=ArsInt64, optional=True)
+    test.add_field(name='name', type=ArsString, optional=True)
+    test.add_field(name='problem', type=ArsInt64, optional=True)
+    test.add_field(name='description', type=ArsString, optional=True)
+    test.add_field(name='environment', type=ArsString, optional=True)
+    test.add_field(name='obsolete', type=ArsBoolean, optional=True)
+    results = ArsStructure(name='result_get_map_result', base_index=0)
+    results.add_field(name='result', type=ArsMap(key_type=ArsString, value_type=attribute), optional=True)
+    tests = ArsStructure(name='Test_filter_result', base_index=0)
+    tests.add_field(name='result', type=ArsList(element_type=test), optional=True)
+    ids = ArsStructure(name='Test_filter_ids_result', base_index=0)
+    ids.add_field(name='result', type=ArsList(element_type=ArsInt64), optional=True)
+    interface = ArsInterface()
+    for type_ in (results, tests, ids):
+        interface.add_type(type_)
+    return (interface, attribute, test, results, tests, ids)
+
+
+def _make_payloads():
+    (interface, attribute, test, results, tests, ids) = _make_interface()
+    result_map = results.get_class()(result=dict(
+        (name, attribute.get_class()(is_blob=is_blob, value=value, filename=filename))
+        for (name, is_blob, value, filename) in [
+            ('status', False, 'OK', None),
+            ('execute_time_cpu', False, '0.132s', None),
+            ('execute_time_real', False, '0.141s', None),
+            ('memory', False, '23412736', None),
+            ('input_file', True, 'mJ1y0bQbMmCAnB8D1xE6h3g1Qq9cNq2e1C0fZ3rQ0kP7tY2uE5sV8wX4zA6bC9dF', '0.in'),
+            ('output_file', True, 'vL8k2pR5tW9yB3nM6qS1xZ4cF7hJ0dG2aE5iO8uY1rT4wQ7eP0sD3fK6gH9jL2', 'stdout'),
+            ('judge_stdout', False, 'Correct answer, 1000 lines checked\n', None),
+        ]))
+    test_list = tests.get_class()(result=[
+        test.get_class()(id=10000 + i, name='test{0:03d}'.format(i), problem=1234,
+            description='', environment='default', obsolete=False)
+        for i in range(200)])
+    id_list = ids.get_class()(result=list(range(10000, 15000)))
+    processor = ThriftProcessor(interface)
+    return (processor, [
+        ('result map', results, result_map),
+        ('200 tests', tests, test_list),
+        ('5000 ids', ids, id_list),
+    ])
+
+
+def _write_reply(processor, struct, value):
+    buf = TMemoryBuffer()
+    proto = TBinaryProtocol(TFramedTransport(buf))
+    proto.writeMessageBegin(struct.name, TMessageType.REPLY, 1)
+    processor.send_struct(value, struct, proto)
+    proto.writeMessageEnd()
+    proto.trans.flush()
+    return buf.getvalue()
+
+
+def _read_reply(processor, struct, data):
+    proto = TBinaryProtocol(TFramedTransport(TMemoryBuffer(data)))
+    proto.readMessageBegin()
+    value = processor.recv_struct(struct, proto)
+    proto.readMessageEnd()
+    return value
+
+
+def _skip_reply(data):
+    proto = TBinaryProtocol(TFramedTransport(TMemoryBuffer(data)))
+    proto.readMessageBegin()
+    proto.skip(TType.STRUCT)
+    proto.readMessageEnd()
+
+
+def _dispatch_send(processor, struct, value):
+    buf = TMemoryBuffer()
+    processor._send(value, struct, TBinaryProtocol(buf))
+    return buf.getvalue()
+
+
+def _time(function, repeat):
+    return min(timeit.repeat(function, number=repeat, repeat=3)) / repeat * 1e6
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    (processor, payloads) = _make_payloads()
+
+    print('Replies over a framed transport, us per message, {0} repetitions:'.format(repeat))
+    for (name, struct, value) in payloads:
+        data = _write_reply(processor, struct, value)
+        (encode, decode) = processor.codec(struct)
+        if encode(value) != _dispatch_send(processor, struct, value):
+            raise RuntimeError('Compiled encoder output differs from the dispatch encoder')
+        print('  {0:<12} {1:>7} bytes: write {2:8.1f}, read {3:8.1f}, protocol skip {4:8.1f}'.format(
+            name, len(data),
+            _time(lambda: _write_reply(processor, struct, value), repeat),
+            _time(lambda: _read_reply(processor, struct, data), repeat),
+            _time(lambda: _skip_reply(data), repeat)))
+
+    # the dispatch path is much slower, so it is measured on the smallest payload only
+    (name, struct, value) = payloads[0]
+    dispatch_repeat = max(1, repeat // 20)
+    (encode, decode) = processor.codec(struct)
+    data = encode(value)
+    print('Dispatch and compiled codec on the {0}, us per structure, {1} repetitions:'.format(name, dispatch_repeat))
+    for (case, dispatch, compiled) in [
+            ('encode',
+                lambda: _dispatch_send(processor, struct, value),
+                lambda: encode(value)),
+            ('decode',
+                lambda: processor._recv(struct, TBinaryProtocol(TMemoryBuffer(data))),
+                lambda: decode(struct.get_class()(), buffer_reader(TMemoryBuffer(data))))]:
+        dispatch_time = _time(dispatch, dispatch_repeat)
+        compiled_time = _time(compiled, dispatch_repeat)
+        print('  {0}: dispatch {1:.1f}, compiled {2:.1f}, {3:.1f}x faster'.format(
+            case, dispatch_time, compiled_time, dispatch_time / compiled_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@
 from __future__ import absolute_import
 
 import errno
+import sys
 import threading
 import socket
 from types import FunctionType
@@ -15,75 +16,373 @@ from thrift.transport.TTransport import TFramedTransport, TTransportException, T
 from thrift.protocol.TBinaryProtocol import TBinaryProtocol
 from thrift.protocol.TCompactProtocol import TCompactProtocol
 
-from satori.ars.model import ArsInterface
+from satori.ars.futures import Future
+from satori.ars.model import ArsInterface, ArsExceptionBase
 from satori.objects import Argument, Signature, ArgumentMode
 from satori.objects import Argument, DispatchOn, Signature, Namespace
 
 from satori.ars.thrift.processor import ThriftProcessor
 
-class ThriftClient(threading.local):
+# connections a ThriftClient keeps open at most for threads outside of pools
+MAX_CONNECTIONS = 8
+
+
+def _values_type(procedure):
+    """Returns a function binding call arguments of the procedure.
+
+    The signature is built on the first call, since most procedures of
+    the interface are never called by a client.
+    """
+    cache = []
+
+    def values(*args, **kwargs):
+        if not cache:
+            sign = Signature([parameter.name for parameter in procedure.parameters])
+            for param in procedure.parameters:
+                if param.optional:
+                    sign.arguments[param.name].mode = ArgumentMode.OPTIONAL
+            cache.append(sign.Values)
+        return cache[0](*args, **kwargs)
+
+    return values
+
+
+class ThriftConnection(object):
+    """A connection making one call at a time.
+    """
+
     @Argument('interface', type=ArsInterface)
     @Argument('transport_factory', type=FunctionType)
-    def __init__(self, interface, transport_factory):
-        super(ThriftClient, self).__init__()
+    def __init__(self, interface, transport_factory, generation=0):
+        self._transport = TFramedTransport(transport_factory())
+        self._transport.open()
+        self.protocol = TBinaryProtocol(self._transport)
+        self.processor = ThriftProcessor(interface)
+        self.generation = generation
+
+    def close(self):
+        self._transport.close()
+
+
+class ThriftClient(object):
+    """Client sharing a bounded pool of connections between threads.
+
+    A call borrows an idle connection, or opens a new one if fewer than
+    max_connections are open, and waits for a connection otherwise. The
+    connection is returned after the call, unless it failed in a way that
+    may leave the connection out of step with the server. Pools of threads
+    calling the client reserve connections for their workers on top of
+    max_connections, which are left for other threads.
+    """
+
+    @Argument('interface', type=ArsInterface)
+    @Argument('transport_factory', type=FunctionType)
+    def __init__(self, interface, transport_factory, max_connections=MAX_CONNECTIONS):
         self._interface = interface
         self._transport_factory = transport_factory
-        self._started = False
+        self._max_connections = max_connections
+        self._reserved = 0
+        self._condition = threading.Condition()
+        self._idle = []
+        self._open = 0
+        # connections of earlier generations are closed by stop()
+        self._generation = 0
+
+    def reserve_connections(self, count):
+        """Lets count more threads call the server at the same time."""
+        with self._condition:
+            self._reserved += count
+            self._condition.notify_all()
+
+    def release_connections(self, count):
+        """Gives back connections reserved with reserve_connections."""
+        with self._condition:
+            self._reserved -= count
 
     def _wrap_procedure(self, procedure):
-        names = [parameter.name for parameter in procedure.parameters]
-        sign = Signature(names)
-        for param in procedure.parameters:
-            if param.optional:
-                sign.arguments[param.name].mode = ArgumentMode.OPTIONAL
-        values_type = sign.Values
+        values_type = _values_type(procedure)
 
         def proc(*args, **kwargs):
-            if not self._started:
-                self.start()
-
             values = values_type(*args, **kwargs)
-            try:
-                return self._processor.call(procedure, values.named, self._protocol, self._protocol)
-            except TTransportException:
-                self.stop()
-                self.start()
-                return self._processor.call(procedure, values.named, self._protocol, self._protocol)
-            except IOError as e:
-                if e[0] == errno.EPIPE:
-                    self.stop()
-                    self.start()
-                    return self._processor.call(procedure, values.named, self._protocol, self._protocol)
-                else:
-                    raise
+            return self._call(lambda connection: connection.processor.call(procedure, values.named, connection.protocol, connection.protocol))
 
         proc.func_name = procedure.name
         return proc
 
+    def _wrap_batch(self, procedure):
+        values_type = _values_type(procedure)
+
+        def batch(args_list):
+            calls = [(procedure, values_type(*args).named) for args in args_list]
+            return self._call(lambda connection: connection.processor.call_many(calls, connection.protocol, connection.protocol))
+
+        batch.func_name = procedure.name + '_batch'
+        return batch
+
+    def _acquire(self):
+        with self._condition:
+            while not self._idle and self._open >= self._max_connections + self._reserved:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+            generation = self._generation
+        try:
+            return ThriftConnection(self._interface, self._transport_factory, generation)
+        except:
+            with self._condition:
+                if generation == self._generation:
+                    self._open -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, connection, reuse):
+        with self._condition:
+            current = connection.generation == self._generation
+            # connections above a lowered limit are closed
+            reuse = reuse and self._open <= self._max_connections + self._reserved
+            if current and reuse:
+                self._idle.append(connection)
+            elif current:
+                self._open -= 1
+            self._condition.notify()
+        if not (current and reuse):
+            connection.close()
+
+    def _call_once(self, call):
+        connection = self._acquire()
+        try:
+            result = call(connection)
+        except ArsExceptionBase:
+            self._release(connection, True)
+            raise
+        except TApplicationException as e:
+            # the connection is out of step with the server
+            self._release(connection, e.type != TApplicationException.BAD_SEQUENCE_ID)
+            raise
+        except:
+            # replies left unread would be taken for replies to later calls
+            self._release(connection, False)
+            raise
+        self._release(connection, True)
+        return result
+
+    def _call(self, call):
+        try:
+            return self._call_once(call)
+        except TTransportException:
+            # idle connections were likely closed by the server as well
+            self._close_idle()
+            return self._call_once(call)
+        except IOError as e:
+            if e[0] == errno.EPIPE:
+                self._close_idle()
+                return self._call_once(call)
+            else:
+                raise
+
+    def _close_idle(self):
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+            self._open -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            connection.close()
+
     def wrap_all(self):
         for service in self._interface.services:
             for procedure in service.procedures:
                 procedure.implementation = self._wrap_procedure(procedure)
+                procedure.batch_implementation = self._wrap_batch(procedure)
 
     def unwrap_all(self):
         for service in self._interface.services:
             for procedure in service.procedures:
                 procedure.implementation = None
+                procedure.batch_implementation = None
 
-    def start(self):
-        if self._started:
-            self.stop()
+    def stop(self):
+        """Closes the idle connections, and the busy ones once returned.
+        """
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+            self._open = 0
+            self._generation += 1
+            self._condition.notify_all()
+        for connection in idle:
+            connection.close()
+
+
+class MultiplexedConnection(object):
+    """A connection carrying many outstanding calls.
+
+    Calling threads write their requests as soon as they are made. A thread
+    of the connection reads the replies and matches them to the calls by
+    seqid.
+    """
 
-        self._transport = TFramedTransport(self._transport_factory())
+    @Argument('interface', type=ArsInterface)
+    @Argument('transport_factory', type=FunctionType)
+    def __init__(self, interface, transport_factory):
+        self._processor = ThriftProcessor(interface)
+        self._socket = transport_factory()
+        self._transport = TFramedTransport(self._socket)
         self._transport.open()
         self._protocol = TBinaryProtocol(self._transport)
-        self._processor = ThriftProcessor(self._interface)
-        self._started = True
+        # Writing may block until the server reads, which it does only after
+        # its replies are read, so replies are handled without _write_lock.
+        self._write_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.closed = False
+        reader = threading.Thread(target=self._read_replies)
+        reader.daemon = True
+        reader.start()
+
+    def call(self, procedure, args):
+        """Sends a call and returns a Future of its result.
+        """
+        future = Future()
+        try:
+            with self._write_lock:
+                seqid = self._processor.send_call(procedure, args, self._protocol)
+                with self._lock:
+                    if self.closed:
+                        raise TTransportException(TTransportException.NOT_OPEN, 'Connection is closed')
+                    self._pending[seqid] = (procedure, future)
+                self._transport.flush()
+        except:
+            exc_info = sys.exc_info()
+            # a request written only in part makes the connection unusable
+            self.close(exc_info)
+            if not future.done():
+                future.set_exception(exc_info)
+        return future
+
+    def _read_replies(self):
+        try:
+            while True:
+                (fname, mtype, rseqid) = self._protocol.readMessageBegin()
+                with self._lock:
+                    call = self._pending.pop(rseqid, None)
+                if call is None:
+                    raise TApplicationException(TApplicationException.BAD_SEQUENCE_ID,
+                        "Reply {0} does not match any call".format(rseqid))
+                (procedure, future) = call
+                try:
+                    result = self._processor.recv_reply(procedure, mtype, self._protocol)
+                except Exception:
+                    future.set_exception()
+                else:
+                    future.set_result(result)
+        except:
+            self.close(sys.exc_info())
+
+    def close(self, exc_info=None):
+        """Closes the connection, failing all outstanding calls.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = self._pending
+            self._pending = {}
+        try:
+            # wakes up the reading thread
+            self._socket.handle.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        self._transport.close()
+        if exc_info is None:
+            ex = TTransportException(TTransportException.NOT_OPEN, 'Connection is closed')
+            exc_info = (type(ex), ex, None)
+        for (procedure, future) in pending.values():
+            future.set_exception(exc_info)
+
+    def discard(self):
+        """Closes the socket in a forked process, where no thread reads replies.
+
+        The socket is not shut down, as the parent process still uses it.
+        """
+        self.closed = True
+        self._pending = {}
+        self._transport.close()
+
+
+class ThriftAsyncClient(object):
+    """Client making calls that return Futures.
+
+    Calls from all threads share a few multiplexed connections. Unlike
+    ThriftClient, failed calls are not retried.
+    """
+
+    @Argument('interface', type=ArsInterface)
+    @Argument('transport_factory', type=FunctionType)
+    def __init__(self, interface, transport_factory, connections=2):
+        self._interface = interface
+        self._transport_factory = transport_factory
+        self._size = connections
+        self._lock = threading.Lock()
+        self._connections = []
+        self._next = 0
+
+    def _connection(self):
+        with self._lock:
+            self._connections = [connection for connection in self._connections if not connection.closed]
+            if len(self._connections) < self._size:
+                connection = MultiplexedConnection(self._interface, self._transport_factory)
+                self._connections.append(connection)
+                return connection
+            self._next = (self._next + 1) % len(self._connections)
+            return self._connections[self._next]
+
+    def call(self, procedure, args):
+        try:
+            connection = self._connection()
+        except:
+            future = Future()
+            future.set_exception()
+            return future
+        return connection.call(procedure, args)
+
+    def _wrap_procedure(self, procedure):
+        values_type = _values_type(procedure)
+
+        def proc(*args, **kwargs):
+            values = values_type(*args, **kwargs)
+            return self.call(procedure, values.named)
+
+        proc.func_name = procedure.name + '_async'
+        return proc
+
+    def wrap_all(self):
+        for service in self._interface.services:
+            for procedure in service.procedures:
+                procedure.async_implementation = self._wrap_procedure(procedure)
+
+    def unwrap_all(self):
+        for service in self._interface.services:
+            for procedure in service.procedures:
+                procedure.async_implementation = None
 
     def stop(self):
-        if self._started:
-            self._transport.close()
-            self._started = False
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for connection in connections:
+            connection.close()
+
+    def discard(self):
+        """Drops the connections inherited by a forked process.
+        """
+        # the lock may have been held by another thread at the fork
+        self._lock = threading.Lock()
+        connections = self._connections
+        self._connections = []
+        for connection in connections:
+            connection.discard()
 
 
 class ThriftHttpClient(threading.local):
@@ -149,12 +448,7 @@ class ThriftHttpClient(threading.local):
 
 
     def _wrap_procedure(self, procedure):
-        names = [parameter.name for parameter in procedure.parameters]
-        sign = Signature(names)
-        for param in procedure.parameters:
-            if param.optional:
-                sign.arguments[param.name].mode = ArgumentMode.OPTIONAL
-        values_type = sign.Values
+        values_type = _values_type(procedure)
 
         def proc(*args, **kwargs):
             if not self._started:
@@ -0,0 +1,265 @@
+# vim:ts=4:sts=4:sw=4:expandtab
+"""Pure Python codec for the binary Thrift protocol.
+
+Encoders and decoders are compiled from the type specs used by fastbinary,
+one function per structure, and produce the same bytes.
+"""
+
+import struct
+
+from six.moves import range
+
+from thrift.Thrift import TType
+from thrift.protocol.TProtocol import TProtocolException
+
+_BYTE = struct.Struct('!b')
+_I16 = struct.Struct('!h')
+_I32 = struct.Struct('!i')
+_I64 = struct.Struct('!q')
+_DOUBLE = struct.Struct('!d')
+_FIELD = struct.Struct('!bh')
+_LIST = struct.Struct('!bi')
+_MAP = struct.Struct('!bbi')
+
+_ATOMIC_SIZE = {
+    TType.BOOL: 1,
+    TType.BYTE: 1,
+    TType.I16: 2,
+    TType.I32: 4,
+    TType.I64: 8,
+    TType.DOUBLE: 8,
+}
+
+_ATOMIC_STRUCT = {
+    TType.BYTE: '_BYTE',
+    TType.I16: '_I16',
+    TType.I32: '_I32',
+    TType.I64: '_I64',
+    TType.DOUBLE: '_DOUBLE',
+}
+
+# lists and sets of these types are packed and unpacked in bulk
+_ATOMIC_FORMAT = {
+    TType.BYTE: 'b',
+    TType.I16: 'h',
+    TType.I32: 'i',
+    TType.I64: 'q',
+    TType.DOUBLE: 'd',
+}
+
+
+def skip(read, ttype):
+    """Reads and drops a value of the given type."""
+    if ttype in _ATOMIC_SIZE:
+        read(_ATOMIC_SIZE[ttype])
+    elif ttype == TType.STRING:
+        read(_I32.unpack(read(4))[0])
+    elif ttype == TType.STRUCT:
+        while True:
+            ftype = _BYTE.unpack(read(1))[0]
+            if ftype == TType.STOP:
+                break
+            read(2)
+            skip(read, ftype)
+    elif ttype == TType.MAP:
+        (ktype, vtype, size) = _MAP.unpack(read(6))
+        for i in range(size):
+            skip(read, ktype)
+            skip(read, vtype)
+    elif ttype in (TType.LIST, TType.SET):
+        (etype, size) = _LIST.unpack(read(5))
+        for i in range(size):
+            skip(read, etype)
+    else:
+        raise TProtocolException(TProtocolException.INVALID_DATA,
+            'Unexpected type {0}'.format(ttype))
+
+
+def buffer_reader(trans):
+    """Returns a function reading exactly the given number of bytes from trans.
+
+    Transports with a cStringIO buffer are read from the buffer directly,
+    the way fastbinary does.
+    """
+    if not hasattr(trans, 'cstringio_refill'):
+        return trans.readAll
+    buffers = [trans.cstringio_buf]
+
+    def read(size):
+        data = buffers[0].read(size)
+        if len(data) < size:
+            buffers[0] = trans.cstringio_refill(data, size)
+            data = buffers[0].read(size)
+        return data
+
+    return read
+
+
+class CodecCompiler(object):
+    """Compiles encoders and decoders of structures from their type specs.
+
+    A type spec is a pair (class, fields) as returned by
+    ThriftProcessor.typeargs for an ArsStructure. The encoder of a structure
+    takes its value and returns the encoded string. The decoder takes an
+    instance of the class and a function reading bytes, and sets the
+    attributes of the instance.
+    """
+
+    def __init__(self):
+        self._names = {}
+        self._specs = []
+        self._globals = {
+            '_BYTE': _BYTE,
+            '_I16': _I16,
+            '_I32': _I32,
+            '_I64': _I64,
+            '_DOUBLE': _DOUBLE,
+            '_LIST': _LIST,
+            '_MAP': _MAP,
+            'range': range,
+            'skip': skip,
+            'pack': struct.pack,
+            'unpack': struct.unpack,
+            'TProtocolException': TProtocolException,
+        }
+
+    def encoder(self, spec):
+        write_name = self._function(spec, 'write', self._write_struct)
+        write = self._globals[write_name]
+
+        def encode(value):
+            parts = []
+            write(value, parts.append)
+            return ''.join(parts)
+
+        return encode
+
+    def decoder(self, spec):
+        return self._globals[self._function(spec, 'read', self._read_struct)]
+
+    def _function(self, spec, kind, generate):
+        key = (id(spec), kind)
+        if key not in self._names:
+            name = '{0}_{1}_{2}'.format(kind, spec[0].__name__, len(self._names))
+            self._names[key] = name
+            # keeps the id unique while the compiled function is in use
+            self._specs.append(spec)
+            self._globals['_class_' + name] = spec[0]
+            lines = []
+            generate(name, spec, lines)
+            exec(compile('\n'.join(lines) + '\n', '<thrift codec {0}>'.format(name), 'exec'), self._globals)
+        return self._names[key]
+
+    def _write_struct(self, name, spec, lines):
+        lines.append('def {0}(value, write):'.format(name))
+        for field in spec[1]:
+            if field is None:
+                continue
+            (fid, ftype, fname, fargs, fdefault) = field
+            lines.append('    v = getattr(value, {0!r}, None)'.format(fname))
+            lines.append('    if v is not None:')
+            lines.append('        write({0!r})'.format(_FIELD.pack(ftype, fid)))
+            self._write_value('v', ftype, fargs, 2, lines)
+        lines.append('    write({0!r})'.format(_BYTE.pack(TType.STOP)))
+
+    def _write_value(self, value, ttype, targs, depth, lines):
+        indent = '    ' * depth
+        if ttype == TType.BOOL:
+            lines.append('{0}write({1!r} if {2} else {3!r})'.format(indent, _BYTE.pack(1), value, _BYTE.pack(0)))
+        elif ttype in _ATOMIC_STRUCT:
+            lines.append('{0}write({1}.pack({2}))'.format(indent, _ATOMIC_STRUCT[ttype], value))
+        elif ttype == TType.STRING:
+            lines.append('{0}write(_I32.pack(len({1})))'.format(indent, value))
+            lines.append('{0}write({1})'.format(indent, value))
+        elif ttype == TType.STRUCT:
+            lines.append('{0}{1}({2}, write)'.format(indent, self._function(targs, 'write', self._write_struct), value))
+        elif ttype in (TType.LIST, TType.SET) and targs[0] in _ATOMIC_FORMAT:
+            etype = targs[0]
+            lines.append('{0}write(_LIST.pack({1}, len({2})))'.format(indent, etype, value))
+            lines.append("{0}write(pack('!{{0}}{1}'.format(len({2})), *{2}))".format(indent, _ATOMIC_FORMAT[etype], value))
+        elif ttype in (TType.LIST, TType.SET):
+            (etype, eargs) = targs
+            item = 'e{0}'.format(depth)
+            lines.append('{0}write(_LIST.pack({1}, len({2})))'.format(indent, etype, value))
+            lines.append('{0}for {1} in {2}:'.format(indent, item, value))
+            self._write_value(item, etype, eargs, depth + 1, lines)
+        elif ttype == TType.MAP:
+            (ktype, kargs, vtype, vargs) = targs
+            key = 'k{0}'.format(depth)
+            item = 'e{0}'.format(depth)
+            lines.append('{0}write(_MAP.pack({1}, {2}, len({3})))'.format(indent, ktype, vtype, value))
+            lines.append('{0}for ({1}, {2}) in {3}.items():'.format(indent, key, item, value))
+            self._write_value(key, ktype, kargs, depth + 1, lines)
+            self._write_value(item, vtype, vargs, depth + 1, lines)
+        else:
+            raise TProtocolException(TProtocolException.INVALID_DATA,
+                'Unexpected type {0}'.format(ttype))
+
+    def _read_struct(self, name, spec, lines):
+        lines.append('def {0}(obj, read):'.format(name))
+        lines.append('    while True:')
+        lines.append('        ftype = _BYTE.unpack(read(1))[0]')
+        lines.append('        if ftype == {0}:'.format(TType.STOP))
+        lines.append('            return obj')
+        lines.append('        fid = _I16.unpack(read(2))[0]')
+        branch = 'if'
+        for field in spec[1]:
+            if field is None:
+                continue
+            (fid, ftype, fname, fargs, fdefault) = field
+            lines.append('        {0} fid == {1} and ftype == {2}:'.format(branch, fid, ftype))
+            self._read_value('v', ftype, fargs, 3, lines)
+            lines.append('            obj.{0} = v'.format(fname))
+            branch = 'elif'
+        if branch == 'if':
+            lines.append('        skip(read, ftype)')
+        else:
+            lines.append('        else:')
+            lines.append('            skip(read, ftype)')
+
+    def _read_value(self, target, ttype, targs, depth, lines):
+        indent = '    ' * depth
+        if ttype == TType.BOOL:
+            lines.append('{0}{1} = read(1) != {2!r}'.format(indent, target, _BYTE.pack(0)))
+        elif ttype in _ATOMIC_STRUCT:
+            lines.append('{0}{1} = {2}.unpack(read({3}))[0]'.format(indent, target, _ATOMIC_STRUCT[ttype], _ATOMIC_SIZE[ttype]))
+        elif ttype == TType.STRING:
+            lines.append('{0}{1} = read(_I32.unpack(read(4))[0])'.format(indent, target))
+        elif ttype == TType.STRUCT:
+            function = self._function(targs, 'read', self._read_struct)
+            lines.append('{0}{1} = {2}(_class_{2}(), read)'.format(indent, target, function))
+        elif ttype in (TType.LIST, TType.SET) and targs[0] in _ATOMIC_FORMAT:
+            etype = targs[0]
+            size = 'n{0}'.format(depth)
+            lines.append('{0}(t, {1}) = _LIST.unpack(read(5))'.format(indent, size))
+            lines.append('{0}if t != {1}:'.format(indent, etype))
+            lines.append('{0}    raise TProtocolException(TProtocolException.INVALID_DATA, "Element type mismatch")'.format(indent))
+            lines.append("{0}{1} = {2}(unpack('!{{0}}{3}'.format({4}), read({4} * {5})))".format(
+                indent, target, 'list' if ttype == TType.LIST else 'set', _ATOMIC_FORMAT[etype], size, _ATOMIC_SIZE[etype]))
+        elif ttype in (TType.LIST, TType.SET):
+            (etype, eargs) = targs
+            size = 'n{0}'.format(depth)
+            item = 'e{0}'.format(depth)
+            lines.append('{0}(t, {1}) = _LIST.unpack(read(5))'.format(indent, size))
+            lines.append('{0}if t != {1}:'.format(indent, etype))
+            lines.append('{0}    raise TProtocolException(TProtocolException.INVALID_DATA, "Element type mismatch")'.format(indent))
+            lines.append('{0}{1} = {2}'.format(indent, target, '[]' if ttype == TType.LIST else 'set()'))
+            lines.append('{0}for i{1} in range({2}):'.format(indent, depth, size))
+            self._read_value(item, etype, eargs, depth + 1, lines)
+            lines.append('{0}    {1}.{2}({3})'.format(indent, target, 'append' if ttype == TType.LIST else 'add', item))
+        elif ttype == TType.MAP:
+            (ktype, kargs, vtype, vargs) = targs
+            size = 'n{0}'.format(depth)
+            key = 'k{0}'.format(depth)
+            item = 'e{0}'.format(depth)
+            lines.append('{0}(t, u, {1}) = _MAP.unpack(read(6))'.format(indent, size))
+            lines.append('{0}if t != {1} or u != {2}:'.format(indent, ktype, vtype))
+            lines.append('{0}    raise TProtocolException(TProtocolException.INVALID_DATA, "Key or value type mismatch")'.format(indent))
+            lines.append('{0}{1} = {{}}'.format(indent, target))
+            lines.append('{0}for i{1} in range({2}):'.format(indent, depth, size))
+            self._read_value(key, ktype, kargs, depth + 1, lines)
+            self._read_value(item, vtype, vargs, depth + 1, lines)
+            lines.append('{0}    {1}[{2}] = {3}'.format(indent, target, key, item))
+        else:
+            raise TProtocolException(TProtocolException.INVALID_DATA,
+                'Unexpected type {0}'.format(ttype))
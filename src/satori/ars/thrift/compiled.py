@@ -0,0 +1,111 @@
+# vim:ts=4:sts=4:sw=4:expandtab
+"""Precompiled form of interfaces read from Thrift IDL.
+
+An interface is compiled into nested tuples of strings, which marshal can
+store, and is built back without parsing the IDL again.
+"""
+
+from satori.ars.model import *
+
+ATOMIC_TYPES = {
+    'binary': ArsBinary,
+    'bool': ArsBoolean,
+    'byte': ArsInt8,
+    'i16': ArsInt16,
+    'i32': ArsInt32,
+    'i64': ArsInt64,
+    'double': ArsFloat,
+    'string': ArsString,
+    'void': ArsVoid,
+}
+
+ATOMIC_NAMES = dict((type_, name) for (name, type_) in ATOMIC_TYPES.items())
+
+
+def _compile_type(type_):
+    if isinstance(type_, ArsAtomicType):
+        return ATOMIC_NAMES[type_]
+    elif isinstance(type_, ArsList):
+        return ('list', _compile_type(type_.element_type))
+    elif isinstance(type_, ArsSet):
+        return ('set', _compile_type(type_.element_type))
+    elif isinstance(type_, ArsMap):
+        return ('map', _compile_type(type_.key_type), _compile_type(type_.value_type))
+    elif isinstance(type_, ArsNamedType):
+        return type_.name
+    else:
+        raise RuntimeError("Unhandled ARS type: {0}".format(type_))
+
+
+def _compile_fields(fields):
+    return tuple((field.name, _compile_type(field.type), field.optional) for field in fields)
+
+
+def compile_interface(interface):
+    """Returns the precompiled form of an interface read by ThriftReader.
+    """
+    types = []
+    for type_ in interface.types:
+        if isinstance(type_, ArsTypeAlias):
+            types.append(('typedef', type_.name, _compile_type(type_.target_type)))
+        elif isinstance(type_, ArsException):
+            types.append(('exception', type_.name, type_.base_index, _compile_fields(type_.fields)))
+        elif isinstance(type_, ArsStructure):
+            types.append(('struct', type_.name, type_.base_index, _compile_fields(type_.fields)))
+        else:
+            raise RuntimeError("Unhandled ARS type: {0}".format(type_))
+    services = []
+    for service in interface.services:
+        procedures = tuple(
+            (procedure.name, _compile_type(procedure.return_type), _compile_fields(procedure.parameters),
+                tuple(exception_type.name for exception_type in procedure.exception_types))
+            for procedure in service.procedures)
+        services.append((service.name, service.base.name if service.base else None, procedures))
+    return (tuple(types), tuple(services))
+
+
+def _build_type(interface, compiled):
+    if isinstance(compiled, tuple):
+        if compiled[0] == 'list':
+            return ArsList(element_type=_build_type(interface, compiled[1]))
+        elif compiled[0] == 'set':
+            return ArsSet(element_type=_build_type(interface, compiled[1]))
+        else:
+            return ArsMap(key_type=_build_type(interface, compiled[1]), value_type=_build_type(interface, compiled[2]))
+    elif compiled in ATOMIC_TYPES:
+        return ATOMIC_TYPES[compiled]
+    else:
+        return interface.types[compiled]
+
+
+def build_interface(compiled):
+    """Builds an interface from its precompiled form.
+
+    The result is the same as reading the IDL the form was compiled from.
+    """
+    (types, services) = compiled
+    interface = ArsInterface()
+    for compiled_type in types:
+        if compiled_type[0] == 'typedef':
+            (_, name, target_type) = compiled_type
+            interface.types.append(ArsTypeAlias(name=name, target_type=_build_type(interface, target_type)))
+            continue
+        (kind, name, base_index, fields) = compiled_type
+        if kind == 'exception':
+            type_ = ArsException(name=name, base_index=base_index)
+        else:
+            type_ = ArsStructure(name=name, base_index=base_index)
+        for (field_name, field_type, optional) in fields:
+            type_.add_field(ArsField(name=field_name, type=_build_type(interface, field_type), optional=optional))
+        interface.types.append(type_)
+    for (name, base, procedures) in services:
+        service = ArsService(name=name, base=interface.services[base] if base else None)
+        for (procedure_name, return_type, parameters, exception_types) in procedures:
+            procedure = ArsProcedure(name=procedure_name, return_type=_build_type(interface, return_type))
+            for (parameter_name, parameter_type, optional) in parameters:
+                procedure.add_parameter(ArsParameter(name=parameter_name, type=_build_type(interface, parameter_type), optional=optional))
+            for exception_type in exception_types:
+                procedure.add_exception(interface.types[exception_type])
+            service.add_procedure(procedure)
+        interface.services.append(service)
+    return interface
@@ -2,21 +2,28 @@
 """Processor for the thrift protocol.
 """
 
+import six
 from six.moves import range
 
 import logging
+import sys
 
 from thrift.Thrift import TType, TProcessor, TMessageType, TApplicationException
 from thrift.transport.TTransport import TFramedTransport
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
 
 from satori.objects import Argument, DispatchOn, Signature, Namespace
 from satori.ars.model import *
 from satori.ars.server import server_info
+from satori.ars.thrift.codec import CodecCompiler, buffer_reader
 try:
     from thrift.protocol import fastbinary
 except:
     fastbinary = None
 
+# calls written ahead of their replies by ThriftProcessor.call_many
+PIPELINE_DEPTH = 64
+
 
 class Struct(dict):
 
@@ -44,6 +51,8 @@ class ThriftProcessor(TProcessor):
     def __init__(self, interface):
         self._procedures = ArsNamedTuple()
         self._typeargs_map = {}
+        self._codec_map = {}
+        self._compiler = CodecCompiler()
         for service in interface.services:
             self._procedures.extend(service.procedures)
         self.seqid = 0
@@ -273,12 +282,20 @@ class ThriftProcessor(TProcessor):
             self._typeargs_map[type_] = self._typeargs(type_)
         return self._typeargs_map[type_]
 
+    def codec(self, struct):
+        """Returns a pair of the compiled encoder and decoder of a structure.
+        """
+        if struct not in self._codec_map:
+            spec = self.typeargs(struct)[1]
+            self._codec_map[struct] = (self._compiler.encoder(spec), self._compiler.decoder(spec))
+        return self._codec_map[struct]
+
     def send_struct(self, value, struct, oproto):
         if fastbinary is not None:
             oproto.trans.write(fastbinary.encode_binary(value, self.typeargs(struct)[1]))
+        elif isinstance(oproto, TBinaryProtocol):
+            oproto.trans.write(self.codec(struct)[0](value))
         else:
-            # the above code that is not using fastbinary is totally untested and should not be used
-            # raise Exception('fastbinary is required')
             self._send(value, struct, oproto)
 
     def recv_struct(self, struct, iproto):
@@ -286,9 +303,9 @@ class ThriftProcessor(TProcessor):
             ret = struct.get_class()()
             fastbinary.decode_binary(ret, iproto.trans, self.typeargs(struct)[1])
             return ret
+        elif isinstance(iproto, TBinaryProtocol):
+            return self.codec(struct)[1](struct.get_class()(), buffer_reader(iproto.trans))
         else:
-            # the above code that is not using fastbinary is totally untested and should not be used
-            # raise Exception('fastbinary is required')
             return self._recv(struct, iproto)
 
     def process(self, iproto, oproto):
@@ -368,27 +385,32 @@ class ThriftProcessor(TProcessor):
 #            perf.end('flush')
 #            perf.end('process')
 
-    def call(self, procedure, args, iproto, oproto):
-#        perf.begin('call')
+    def _get_procedure(self, procedure):
         if isinstance(procedure, str):
             try:
-                procedure = self._procedures[procedure]
+                return self._procedures[procedure]
             except KeyError:
                 raise TApplicationException(TApplicationException.UNKNOWN_METHOD,
-                    "Unknown method '{0}'".format(name))
+                    "Unknown method '{0}'".format(procedure))
+        return procedure
 
-#        perf.begin('send')
-        oproto.writeMessageBegin(procedure.name, TMessageType.CALL, self.seqid)
+    def send_call(self, procedure, args, oproto):
+        """Writes a call without flushing the transport. Returns its seqid.
+        """
+        procedure = self._get_procedure(procedure)
+
+        seqid = self.seqid
         self.seqid = self.seqid + 1
+#        perf.begin('send')
+        oproto.writeMessageBegin(procedure.name, TMessageType.CALL, seqid)
         self.send_struct(Namespace(args), procedure.parameters_struct, oproto)
         oproto.writeMessageEnd()
-        oproto.trans.flush()
 #        perf.end('send')
+        return seqid
 
-#        perf.begin('wait')
-        (fname, mtype, rseqid) = iproto.readMessageBegin()
-#        perf.end('wait')
-
+    def recv_reply(self, procedure, mtype, iproto):
+        """Reads a reply after its message header. Returns the result or raises the exception.
+        """
 #        perf.begin('recv')
         if mtype == TMessageType.EXCEPTION:
             x = TApplicationException()
@@ -399,16 +421,68 @@ class ThriftProcessor(TProcessor):
         result = self.recv_struct(procedure.results_struct, iproto)
         iproto.readMessageEnd()
 #        perf.end('recv')
-#        perf.end('call')
 
-        if result.get('result', None) is not None:
+        if getattr(result, 'result', None) is not None:
             return result.result
 
         for field in procedure.results_struct.fields:
-            if result.has_key(field.name) and getattr(result, field.name) is not None:
+            if getattr(result, field.name, None) is not None:
                 raise getattr(result, field.name)
 
         return None
 #       previous line not compatible with Thrift, should be:
 #        raise TApplicationException(TApplicationException.MISSING_RESULT, "Static_call_me failed: unknown result");
 
+    def call(self, procedure, args, iproto, oproto):
+#        perf.begin('call')
+        procedure = self._get_procedure(procedure)
+
+        seqid = self.send_call(procedure, args, oproto)
+        oproto.trans.flush()
+
+#        perf.begin('wait')
+        (fname, mtype, rseqid) = iproto.readMessageBegin()
+#        perf.end('wait')
+        if rseqid != seqid:
+            raise TApplicationException(TApplicationException.BAD_SEQUENCE_ID,
+                "Reply {0} does not match call {1}".format(rseqid, seqid))
+
+        result = self.recv_reply(procedure, mtype, iproto)
+#        perf.end('call')
+        return result
+
+    def call_many(self, calls, iproto, oproto, depth=PIPELINE_DEPTH):
+        """Makes many calls over one connection, without waiting for each reply.
+
+        calls is a list of (procedure, args) pairs. Up to depth requests are
+        written ahead of the replies read, which are matched to the calls by
+        seqid. Returns the list of results. If any call failed, its
+        exception is raised only after all replies were read, so that the
+        connection can still be used.
+        """
+        calls = [(self._get_procedure(procedure), args) for (procedure, args) in calls]
+        results = [None] * len(calls)
+        pending = {}
+        failure = None
+        sent = 0
+        while sent < len(calls) or pending:
+            while sent < len(calls) and len(pending) < depth:
+                (procedure, args) = calls[sent]
+                pending[self.send_call(procedure, args, oproto)] = sent
+                oproto.trans.flush()
+                sent += 1
+
+            (fname, mtype, rseqid) = iproto.readMessageBegin()
+            if rseqid not in pending:
+                raise TApplicationException(TApplicationException.BAD_SEQUENCE_ID,
+                    "Reply {0} does not match any call".format(rseqid))
+            index = pending.pop(rseqid)
+            try:
+                results[index] = self.recv_reply(calls[index][0], mtype, iproto)
+            except (ArsExceptionBase, TApplicationException):
+                # the reply was read whole
+                if failure is None:
+                    failure = sys.exc_info()
+        if failure is not None:
+            six.reraise(*failure)
+        return results
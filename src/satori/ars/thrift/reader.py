@@ -2,7 +2,7 @@
 """IDL reader for the thrift protocol.
 """
 
-from ply import lex, yacc
+import sys
 
 from satori.objects import Argument
 from satori.ars.model import *
@@ -41,8 +41,6 @@ def t_NUMBER(t):
 def t_error(t):
     raise RuntimeError('Illegal character \'{0}\''.format(t.value[0]))
 
-lexer = lex.lex(debug=0)
-
 ATOMIC_TYPES = {
     'binary': ArsBinary,
     'bool': ArsBoolean,
@@ -201,7 +199,19 @@ def p_error(p):
 
 start = 'toplevel'
 
-parser = yacc.yacc(write_tables=0, debug=0)
+_lexer = None
+_parser = None
+
+def _get_parser():
+    # building the parse tables takes long and ply is not needed when the
+    # interface comes from the cache, so both are deferred to the first parse
+    global _lexer, _parser
+    if _parser is None:
+        from ply import lex, yacc
+        module = sys.modules[__name__]
+        _lexer = lex.lex(module=module, debug=0)
+        _parser = yacc.yacc(module=module, write_tables=0, debug=0)
+    return (_lexer, _parser)
 
 class ThriftReader(object):
     def read_from(self, file):
@@ -209,6 +219,7 @@ class ThriftReader(object):
         return self.read_from_string(data)
 
     def read_from_string(self, string):
+        (lexer, parser) = _get_parser()
         parser.interface = ArsInterface()
         parser.parse(string, lexer=lexer)
         return parser.interface
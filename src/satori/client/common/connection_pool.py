@@ -0,0 +1,60 @@
+# vim:ts=4:sts=4:sw=4:expandtab
+
+import select
+import socket
+import threading
+
+from six.moves.http_client import HTTPConnection, HTTPSConnection, HTTPException
+
+# errors showing that a kept-alive connection was closed by the server
+STALE_CONNECTION_ERRORS = (socket.error, HTTPException)
+
+class ConnectionPool(threading.local):
+    """Idle keep-alive HTTP connections, kept separately by every thread.
+
+    Connections are keyed by (host, port, ssl). A connection is returned to
+    the pool only after its response was read completely.
+    """
+    max_idle = 4
+
+    def __init__(self):
+        self._idle = {}
+
+    def get(self, host, port, ssl):
+        """Returns a pair of a connection and whether it was used before."""
+        connections = self._idle.get((host, port, ssl))
+        while connections:
+            con = connections.pop()
+            if self._is_alive(con):
+                return (con, True)
+            con.close()
+        if ssl:
+            return (HTTPSConnection(host, port), False)
+        return (HTTPConnection(host, port), False)
+
+    def put(self, host, port, ssl, con):
+        connections = self._idle.setdefault((host, port, ssl), [])
+        if con.sock is None or len(connections) >= self.max_idle:
+            con.close()
+        else:
+            connections.append(con)
+
+    def clear(self):
+        for connections in self._idle.values():
+            for con in connections:
+                con.close()
+        self._idle = {}
+
+    @staticmethod
+    def _is_alive(con):
+        # an idle connection has nothing to read, unless the server closed it
+        if con.sock is None:
+            return False
+        try:
+            (readable, _, _) = select.select([con.sock], [], [], 0)
+        except (socket.error, select.error, ValueError):
+            return False
+        return not readable
+
+connection_pool = ConnectionPool()
+
@@ -5,37 +5,57 @@ from __future__ import absolute_import
 import six
 
 import getpass
+import hashlib
 import logging
+import marshal
 if six.PY2:
     import new
 import os
 import shutil
 import sys
+import tempfile
+import time
 import urllib
-from six.moves.http_client import HTTPConnection, HTTPSConnection
 from six import StringIO
 from types import FunctionType
 
 from thrift.transport.TSocket import TSocket
 from thrift.transport.TSSLSocket import TSSLSocket
 from thrift.transport.THttpClient import THttpClient
+from thrift.Thrift import TApplicationException
 
 from satori.client.common import setup_api
 from satori.ars.model import ArsString, ArsProcedure, ArsService, ArsInterface
-from satori.ars.thrift import ThriftClient, ThriftReader, ThriftHttpClient
+from satori.ars.thrift import ThriftClient, ThriftReader, ThriftHttpClient, ThriftAsyncClient
+from satori.ars.thrift.compiled import compile_interface, build_interface
 from satori.objects import Argument, Signature, ArgumentMode
 from satori.client.common.unwrap import unwrap_interface
 from satori.client.common.oa_map import get_oa_map
 from satori.client.common.token_container import token_container
+from satori.client.common.connection_pool import connection_pool, STALE_CONNECTION_ERRORS
+from util.paths import cache_path
 
 client_host = ''
 client_port = 0
 blob_port = 0
 ssl = True
 
+_client = None
+# makes the *_async calls; connects on the first one
+_async_client = None
+
 http = False
 #http = True
 
+# interfaces compiled from the IDL of the server are cached by the hash of the
+# IDL, and removed when not used for this long
+IDL_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+IDL_CACHE_FORMAT = 2
+
+# errors of calls made with an interface the server does not have anymore
+STALE_INTERFACE_ERRORS = (TApplicationException.UNKNOWN_METHOD,
+        TApplicationException.WRONG_METHOD_NAME, TApplicationException.PROTOCOL_ERROR)
+
 def transport_factory():
 #    return THttpClient(("https" if ssl else "http") + "://" + client_host + ":" + str(client_port) + "/thrift")
     if ssl:
@@ -43,8 +63,49 @@ def transport_factory():
     else:
         return TSocket(host=client_host, port=client_port)
 
-@Argument('transport_factory', type=FunctionType)
-def bootstrap_thrift_client(transport_factory):
+def idl_cache_path(idl_hash):
+    return cache_path('idl', idl_hash + '.marshal')
+
+def _read_idl_cache(path):
+    """Returns the compiled interface stored in a cache entry, or None.
+    """
+    try:
+        with open(path, 'rb') as cache_file:
+            (cache_format, compiled) = marshal.load(cache_file)
+    except (EnvironmentError, EOFError, ValueError, TypeError):
+        return None
+    if cache_format != IDL_CACHE_FORMAT:
+        return None
+    try:
+        # renews the age of the entry
+        os.utime(path, None)
+    except EnvironmentError:
+        pass
+    return compiled
+
+def _write_idl_cache(path, compiled):
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        (fd, temp_path) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as cache_file:
+            marshal.dump((IDL_CACHE_FORMAT, compiled), cache_file)
+        os.rename(temp_path, path)
+        now = time.time()
+        for name in os.listdir(directory):
+            entry = os.path.join(directory, name)
+            if now - os.path.getmtime(entry) > IDL_CACHE_MAX_AGE:
+                os.remove(entry)
+    except EnvironmentError:
+        logging.debug('Cannot write the IDL cache %s', path, exc_info=True)
+
+def is_stale_interface_error(ex):
+    """Tells whether ex shows that the server interface changed since setup.
+    """
+    return isinstance(ex, TApplicationException) and ex.type in STALE_INTERFACE_ERRORS
+
+def _get_idl(transport_factory):
     interface = ArsInterface()
     idl_proc = ArsProcedure(return_type=ArsString, name='Server_getIDL')
     idl_serv = ArsService(name='Server')
@@ -58,18 +119,65 @@ def bootstrap_thrift_client(transport_factory):
     bootstrap_client.wrap_all()
     idl = idl_proc.implementation()
     bootstrap_client.stop()
+    return idl
+
+def _read_interface(transport_factory, check_idl):
+    # The IDL is downloaded on every start, so that the interface is always
+    # the one of the server, and parsed only if no interface compiled from
+    # the same IDL is cached, or check_idl is set.
+    idl = _get_idl(transport_factory)
+    idl_path = idl_cache_path(hashlib.sha1(idl).hexdigest())
+    compiled = None if check_idl else _read_idl_cache(idl_path)
+    if compiled is not None:
+        logging.debug('Using cached IDL %s', idl_path)
+        return build_interface(compiled)
+
+    interface = ThriftReader().read_from_string(idl)
+    _write_idl_cache(idl_path, compile_interface(interface))
+    return interface
 
-    idl_reader = ThriftReader()
-    interface = idl_reader.read_from_string(idl)
+@Argument('transport_factory', type=FunctionType)
+def bootstrap_thrift_client(transport_factory, check_idl=False):
+    global _async_client
+    interface = _read_interface(transport_factory, check_idl)
 
+    if _async_client is not None:
+        _async_client.stop()
+        _async_client = None
     if not http:
         client = ThriftClient(interface, transport_factory)
+        _async_client = ThriftAsyncClient(interface, transport_factory)
+        _async_client.wrap_all()
     else:
         client = ThriftHttpClient(interface, client_host, blob_port, ssl)
     client.wrap_all()
 
     return (interface, client)
 
+def _blob_request(method, url, headers, get_response=True):
+    # a kept-alive connection may have been closed by the server since its
+    # last use, in which case the request is repeated on a new connection
+    while True:
+        (con, reused) = connection_pool.get(client_host, blob_port, ssl)
+        try:
+            con.request(method, url, '', headers)
+            res = con.getresponse() if get_response else None
+        except STALE_CONNECTION_ERRORS:
+            con.close()
+            if reused:
+                continue
+            raise
+        except:
+            con.close()
+            raise
+        return (con, res)
+
+def _blob_release(con, res):
+    if res.isclosed() and not res.will_close:
+        connection_pool.put(client_host, blob_port, ssl, con)
+    else:
+        con.close()
+
 class BlobWriter(object):
     def __init__(self, length, model=None, id=None, name=None, group=None, filename=''):
         if model:
@@ -83,16 +191,7 @@ class BlobWriter(object):
         headers['Content-length'] = str(length)
         headers['Filename'] = urllib.quote(filename)
 
-        if ssl:
-            self.con = HTTPSConnection(client_host, blob_port)
-        else:
-            self.con = HTTPConnection(client_host, blob_port)
-
-        try:
-            self.con.request('PUT', url, '', headers)
-        except:
-            self.con.close()
-            raise
+        (self.con, _) = _blob_request('PUT', url, headers, get_response=False)
 
     def write(self, data):
         try:
@@ -109,12 +208,19 @@ class BlobWriter(object):
                 raise Exception("Server returned %d (%s) answer." % (res.status, res.reason))
             length = int(res.getheader('Content-length'))
             ret = res.read(length)
-        finally:
+        except:
             self.con.close()
+            raise
+        _blob_release(self.con, res)
         return ret
 
+class RangeNotSatisfiable(Exception):
+    """The server has no content of a BLOB from the requested offset on."""
+
 class BlobReader(object):
-    def __init__(self, model=None, id=None, name=None, group=None, hash=None):
+    # offset asks for the content from the given byte on, which servers
+    # may ignore; self.offset tells where the returned content starts
+    def __init__(self, model=None, id=None, name=None, group=None, hash=None, offset=0):
         if model:
             url = '/blob/{0}/{1}/{2}/{3}'.format(urllib.quote(model), str(id), urllib.quote(group), urllib.quote(name))
         else:
@@ -124,25 +230,23 @@ class BlobReader(object):
         headers['Host'] = urllib.quote(client_host)
         headers['Cookie'] = 'satori_token=' + urllib.quote(token_container.get_token())
         headers['Content-length'] = '0'
+        if offset:
+            headers['Range'] = 'bytes={0}-'.format(offset)
 
+        (self.con, self.res) = _blob_request('GET', url, headers)
         try:
-            self.con = None
-
-            if ssl:
-                self.con = HTTPSConnection(client_host, blob_port)
+            if self.res.status == 206 and offset:
+                self.offset = offset
+            elif self.res.status == 200:
+                self.offset = 0
+            elif self.res.status == 416 and offset:
+                raise RangeNotSatisfiable("Server returned %d (%s) answer." % (self.res.status, self.res.reason))
             else:
-                self.con = HTTPConnection(client_host, blob_port)
-
-            self.con.request('GET', url, '', headers)
-
-            self.res = self.con.getresponse()
-            if self.res.status != 200:
                 raise Exception("Server returned %d (%s) answer." % (self.res.status, self.res.reason))
             self.length = int(self.res.getheader('Content-length'))
             self.filename = urllib.unquote(self.res.getheader('Filename', ''))
         except:
-            if self.con:
-                self.con.close()
+            self.con.close()
             raise
 
     def read(self, len):
@@ -154,10 +258,35 @@ class BlobReader(object):
         return ret
 
     def close(self):
-        self.con.close()
-
-def setup(host, thrift_port, blob_port_, ssl_):
-    global client_host, client_port, blob_port, ssl
+        _blob_release(self.con, self.res)
+
+def reserve_connections(count):
+    """Lets count more threads call the server at the same time.
+
+    Threads of the HTTP client have connections of their own.
+    """
+    if isinstance(_client, ThriftClient):
+        _client.reserve_connections(count)
+
+def release_connections(count):
+    """Gives back connections reserved with reserve_connections."""
+    if isinstance(_client, ThriftClient):
+        _client.release_connections(count)
+
+def reset_connections():
+    """Closes the connections of the calling thread.
+
+    A forked process must not use the connections inherited from its parent,
+    new ones are opened on the next call.
+    """
+    if _client is not None:
+        _client.stop()
+    if _async_client is not None:
+        _async_client.discard()
+    connection_pool.clear()
+
+def setup(host, thrift_port, blob_port_, ssl_, check_idl=False):
+    global client_host, client_port, blob_port, ssl, _client
     client_host = host
     client_port = thrift_port
     blob_port = blob_port_
@@ -165,7 +294,7 @@ def setup(host, thrift_port, blob_port_, ssl_):
 
     logging.debug('Bootstrapping client...')
 
-    (_interface, _client) = bootstrap_thrift_client(transport_factory)
+    (_interface, _client) = bootstrap_thrift_client(transport_factory, check_idl)
     _classes = unwrap_interface(_interface, BlobReader, BlobWriter)
 
     _classes['token_container'] = token_container
@@ -0,0 +1,64 @@
+# vim:ts=4:sts=4:sw=4:expandtab
+"""Tokens kept on disk between runs, per server and user or machine.
+
+Token files are readable by their owner only. A token older than
+TOKEN_CACHE_MAX_AGE is not used; a token rejected by the server earlier is
+replaced on the next authentication.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from util.paths import cache_path
+
+TOKEN_CACHE_MAX_AGE = 6 * 60 * 60
+
+
+def token_path(host, port, kind, name):
+    """Returns the path of the token of a user or machine (kind) on a server.
+
+    The file name is hashed, as user names may contain any characters.
+    """
+    key = hashlib.sha1(repr((host, port, kind, name))).hexdigest()
+    return cache_path('tokens', key)
+
+
+def read_token(path):
+    """Returns the token stored in path, or None if it is missing or too old."""
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if age > TOKEN_CACHE_MAX_AGE:
+            return None
+        with open(path, 'rb') as token_file:
+            token = token_file.read()
+    except EnvironmentError:
+        return None
+    return token or None
+
+
+def write_token(path, token):
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        # mkstemp creates the file with mode 0600
+        (fd, temporary) = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as token_file:
+                token_file.write(token)
+            os.rename(temporary, path)
+        except:
+            os.unlink(temporary)
+            raise
+    except EnvironmentError as e:
+        logging.warning('Cannot store the token in %s: %s', path, e)
+
+
+def remove_token(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -2,9 +2,20 @@
 
 import threading
 
-class TokenContainer(threading.local):
+class TokenContainer(object):
+    """The token sent with calls from all threads of the process.
+
+    A thread may override it with a token of its own.
+    """
+
     def __init__(self):
         self._token = ""
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        # returns a new token when the server rejects the current one, or
+        # None if it cannot
+        self._refresh = None
+        self._refreshing = False
 
     def set_token(self, token):
         self._token = token
@@ -13,7 +24,44 @@ class TokenContainer(threading.local):
         self._token = ""
 
     def get_token(self):
-        return self._token
+        token = getattr(self._local, 'token', None)
+        if token is None:
+            return self._token
+        return token
 
-token_container = TokenContainer()
+    def set_thread_token(self, token):
+        """Overrides the token in the calling thread."""
+        self._local.token = token
+
+    def unset_thread_token(self):
+        self._local.token = None
 
+    def set_refresh(self, refresh):
+        self._refresh = refresh
+
+    def refresh_token(self, rejected):
+        """Replaces the token rejected by the server.
+
+        Threads which had the same token rejected refresh it only once.
+        Returns whether get_token returns a new token. Tokens set for
+        a thread are not refreshed.
+        """
+        if getattr(self._local, 'token', None) is not None:
+            return False
+        with self._lock:
+            if self._token != rejected:
+                # refreshed by another thread in the meantime
+                return True
+            if self._refresh is None or self._refreshing:
+                return False
+            self._refreshing = True
+            try:
+                token = self._refresh()
+            finally:
+                self._refreshing = False
+            if token is None:
+                return False
+            self._token = token
+            return True
+
+token_container = TokenContainer()
@@ -7,10 +7,37 @@ import six
 import os
 import shutil
 import logging
+import sys
+import threading
+from satori.ars.futures import Future
 from satori.ars.model import ArsType, ArsTypeAlias, ArsInt64, ArsStructure, ArsExceptionBase, ArsDateTime
 from satori.ars import perf
 from satori.client.common.token_container import token_container
 
+# bytes copied at a time by the *_path BLOB helpers
+BLOB_BUFFER_SIZE = 1024 * 1024
+
+# threads running the *_async variants of the BLOB helpers; BLOBs are
+# transferred over HTTP, which the asynchronous Thrift client does not carry
+BLOB_ASYNC_THREADS = 8
+
+# Methods taking only self, whose results are cached by every object, by class
+# name. A result is cached once the predicate accepts it; None accepts every
+# result. Filled by cache_results.
+CACHED_METHODS = {}
+
+# exceptions after which a call is retried once with a refreshed token
+TOKEN_EXCEPTIONS = ('TokenInvalid', 'TokenExpired')
+
+def cache_results(class_name, meth_name, is_final=None):
+    """Makes every object of class_name cache results of meth_name.
+
+    A result is cached once is_final accepts it, or always if is_final is
+    None. Applies to classes unwrapped afterwards, i.e. must be called
+    before the client is set up.
+    """
+    CACHED_METHODS.setdefault(class_name, {})[meth_name] = is_final
+
 class ArsUnwrapId(ArsTypeAlias):
     def __init__(self, cls):
         super(ArsUnwrapId, self).__init__(name=cls.__name__, target_type=ArsInt64)
@@ -49,6 +76,7 @@ class UnwrapBase(object):
         super(UnwrapBase, self).__init__()
         self._id = _id
         self._struct = _struct
+        self._cache = {}
     
     def __eq__(self, other):
         return (isinstance(other, self.__class__) or isinstance(self, other.__class__)) and self.id == other._id
@@ -67,7 +95,7 @@ class StubCodeLoader(object):
     def get_source(self, module_name):
         return 'thrift code\nraise {0} error\n'.format(self.method_name)
 
-def unwrap_procedure(_proc):
+def unwrap_procedure(_proc, _asynchronous=False):
     _procname = _proc.name
     _implementation = _proc.implementation
     _rettype = _proc.return_type
@@ -87,8 +115,9 @@ def unwrap_procedure(_proc):
 
         logging.debug('Calling procedure %s', _procname)
         perf.begin('args')
+        token = token_container.get_token()
         if _token_type is not None:
-            newargs.append(_token_type.convert_to_ars(token_container.get_token()))
+            newargs.append(_token_type.convert_to_ars(token))
 
         if len(args) > len(_args):
             raise TypeError('{0}() takes at most {1} arguments ({2} given)'.format(_procname, len(_args), len(args)))
@@ -105,61 +134,210 @@ def unwrap_procedure(_proc):
             newkwargs[name] = argtype.convert_to_ars(value)
         perf.end('args')
 
+        if _asynchronous:
+            if _proc.async_implementation is None:
+                raise RuntimeError('{0}_async() needs an asynchronous client'.format(_procname))
+            return unwrap_future(_proc.async_implementation(*newargs, **newkwargs), _rettype)
+
         try:
             perf.begin('call')
             ret = _implementation(*newargs, **newkwargs)
             perf.end('call')
         except ArsExceptionBase as ex:
-            ex = ex.ars_type().convert_from_ars(ex)
-            reraise = compile('def ' + _procname + '():\n raise ex\n', '<thrift>', 'exec')
-            exception = {'ex': ex, '__loader__': StubCodeLoader(_procname)}
-            exec_(reraise, exception)
-            exception[_procname]()
+            if not (_token_type is not None and rejects_token(ex) and token_container.refresh_token(token)):
+                raise_unwrapped(_procname, ex)
+            newargs[0] = _token_type.convert_to_ars(token_container.get_token())
+            try:
+                ret = _implementation(*newargs, **newkwargs)
+            except ArsExceptionBase as ex:
+                raise_unwrapped(_procname, ex)
             
         perf.begin('ret')
         ret = _rettype.convert_from_ars(ret)
         perf.end('ret')
         return ret
 
-    func.func_name = _procname
+    def call_many(args_list, pool_map=map):
+        """Calls the procedure with every tuple of arguments in args_list.
+
+        The calls are pipelined over one connection if the client supports
+        it, and made with pool_map otherwise. Returns the list of results.
+        """
+        args_list = list(args_list)
+        if _proc.batch_implementation is None:
+            return pool_map(lambda args: func(*args), args_list)
+
+        token = token_container.get_token()
+        batch = []
+        for args in args_list:
+            if len(args) > len(_args):
+                raise TypeError('{0}() takes at most {1} arguments ({2} given)'.format(_procname, len(_args), len(args)))
+            newargs = [argtype.convert_to_ars(value) for ((name, argtype, optional), value) in zip(_args, args)]
+            if _token_type is not None:
+                newargs.insert(0, _token_type.convert_to_ars(token))
+            batch.append(newargs)
+
+        try:
+            rets = _proc.batch_implementation(batch)
+        except ArsExceptionBase as ex:
+            if not (_token_type is not None and rejects_token(ex) and token_container.refresh_token(token)):
+                raise_unwrapped(_procname, ex)
+            # all calls of a batch carry the same token, so it is sent again whole
+            token = _token_type.convert_to_ars(token_container.get_token())
+            for newargs in batch:
+                newargs[0] = token
+            try:
+                rets = _proc.batch_implementation(batch)
+            except ArsExceptionBase as ex:
+                raise_unwrapped(_procname, ex)
+        return [_rettype.convert_from_ars(ret) for ret in rets]
+
+    func.func_name = _procname + ('_async' if _asynchronous else '')
+    if not _asynchronous:
+        func.call_many = call_many
 
     if not (_args and ((_args[0][0] == 'self') or (_args[0][0] == '_self'))):
-        func = staticmethod(func)
+        return staticmethod(func)
+
+    return func
+
+def rejects_token(ex):
+    """Tells whether ex is raised by the server for an invalid or expired token.
+    """
+    return ex.ars_type().name in TOKEN_EXCEPTIONS
+
+def raise_unwrapped(procname, ex):
+    """Raises the client exception converted from ex, as if raised by procname.
+    """
+    ex = ex.ars_type().convert_from_ars(ex)
+    reraise = compile('def ' + procname + '():\n raise ex\n', '<thrift>', 'exec')
+    exception = {'ex': ex, '__loader__': StubCodeLoader(procname)}
+    exec_(reraise, exception)
+    exception[procname]()
+
+def unwrap_future(future, rettype):
+    """Converts the outcome of an asynchronous call like unwrap_procedure does.
+    """
+    unwrapped = Future()
+
+    def done(future):
+        try:
+            ret = future.result()
+        except ArsExceptionBase as ex:
+            ex = ex.ars_type().convert_from_ars(ex)
+            unwrapped.set_exception((type(ex), ex, sys.exc_info()[2]))
+        except:
+            unwrapped.set_exception()
+        else:
+            try:
+                ret = rettype.convert_from_ars(ret)
+            except:
+                unwrapped.set_exception()
+            else:
+                unwrapped.set_result(ret)
 
+    future.add_done_callback(done)
+    return unwrapped
+
+_MISSING = object()
+
+def unwrap_cached_procedure(_proc, _is_final, _asynchronous=False):
+    _func = unwrap_procedure(_proc, _asynchronous)
+
+    def store(obj, ret):
+        if _is_final is None or _is_final(ret):
+            obj._cache[_proc.name] = ret
+        return ret
+
+    def func(self):
+        ret = self._cache.get(_proc.name, _MISSING)
+        if ret is _MISSING:
+            if _asynchronous:
+                return _func(self).then(lambda ret: store(self, ret))
+            return store(self, _func(self))
+        if _asynchronous:
+            future = Future()
+            future.set_result(ret)
+            return future
+        return ret
+
+    def call_many(args_list, pool_map=map):
+        args_list = list(args_list)
+        rets = [obj._cache.get(_proc.name, _MISSING) for (obj,) in args_list]
+        missing = [i for (i, ret) in enumerate(rets) if ret is _MISSING]
+        fetched = _func.call_many([args_list[i] for i in missing], pool_map)
+        for (i, ret) in zip(missing, fetched):
+            rets[i] = store(args_list[i][0], ret)
+        return rets
+
+    func.func_name = _proc.name + ('_async' if _asynchronous else '')
+    if not _asynchronous:
+        func.call_many = call_many
     return func
 
+_blob_pool = None
+_blob_pool_pid = None
+_blob_pool_lock = threading.Lock()
+
+def _blob_async(func):
+    """Returns a variant of a BLOB helper returning a Future of its result."""
+    def func_async(*args, **kwargs):
+        global _blob_pool, _blob_pool_pid
+        with _blob_pool_lock:
+            # threads of a pool do not survive a fork
+            if _blob_pool is None or _blob_pool_pid != os.getpid():
+                from multiprocessing.pool import ThreadPool
+                _blob_pool = ThreadPool(BLOB_ASYNC_THREADS)
+                _blob_pool_pid = os.getpid()
+            pool = _blob_pool
+        future = Future()
+
+        def run():
+            try:
+                ret = func(*args, **kwargs)
+            except:
+                future.set_exception()
+            else:
+                future.set_result(ret)
+
+        pool.apply_async(run)
+        return future
+
+    func_async.func_name = func.func_name + '_async'
+    return func_async
+
 def unwrap_blob_create(class_dict, class_name, meth_name, BlobWriter):
-    @staticmethod
     def create_blob(length):
         return BlobWriter(length)
 
-    class_dict[meth_name] = create_blob
+    class_dict[meth_name] = staticmethod(create_blob)
+    class_dict[meth_name + '_async'] = staticmethod(_blob_async(create_blob))
 
-    @staticmethod
     def create_path(path):
-        with open(path, 'r') as src:
+        with open(path, 'rb') as src:
             ln = os.fstat(src.fileno()).st_size
             blob = BlobWriter(ln)
-            shutil.copyfileobj(src, blob, ln)
+            shutil.copyfileobj(src, blob, BLOB_BUFFER_SIZE)
         return blob.close()
 
-    class_dict[meth_name + '_path'] = create_path
+    class_dict[meth_name + '_path'] = staticmethod(create_path)
+    class_dict[meth_name + '_path_async'] = staticmethod(_blob_async(create_path))
 
 def unwrap_blob_open(class_dict, class_name, meth_name, BlobReader):
-    @staticmethod
-    def open_blob(hash):
-        return BlobReader(hash=hash)
+    def open_blob(hash, offset=0):
+        return BlobReader(hash=hash, offset=offset)
 
-    class_dict[meth_name] = open_blob
+    class_dict[meth_name] = staticmethod(open_blob)
+    class_dict[meth_name + '_async'] = staticmethod(_blob_async(open_blob))
 
-    @staticmethod
     def open_path(hash, path):
-        with open(path, 'w') as dst:
+        with open(path, 'wb') as dst:
             blob = BlobReader(hash=hash)
-            shutil.copyfileobj(blob, dst, blob.length)
+            shutil.copyfileobj(blob, dst, BLOB_BUFFER_SIZE)
         return blob.close()
 
-    class_dict[meth_name + '_path'] = open_path
+    class_dict[meth_name + '_path'] = staticmethod(open_path)
+    class_dict[meth_name + '_path_async'] = staticmethod(_blob_async(open_path))
 
 def unwrap_blob_get(class_dict, class_name, meth_name, BlobReader):
     group_name = meth_name[:-9]
@@ -168,14 +346,16 @@ def unwrap_blob_get(class_dict, class_name, meth_name, BlobReader):
         return BlobReader(class_name, self.id, name, group_name)
 
     class_dict[meth_name] = blob_get
+    class_dict[meth_name + '_async'] = _blob_async(blob_get)
 
     def blob_get_path(self, name, path):
-        with open(path, 'w') as dst:
+        with open(path, 'wb') as dst:
             blob = blob_get(self, name)
-            shutil.copyfileobj(blob, dst, blob.length)
+            shutil.copyfileobj(blob, dst, BLOB_BUFFER_SIZE)
         return blob.close()
 
     class_dict[meth_name + '_path'] = blob_get_path
+    class_dict[meth_name + '_path_async'] = _blob_async(blob_get_path)
 
 def unwrap_blob_set(class_dict, class_name, meth_name, BlobWriter):
     group_name = meth_name[:-9]
@@ -184,15 +364,17 @@ def unwrap_blob_set(class_dict, class_name, meth_name, BlobWriter):
         return BlobWriter(length, class_name, self.id, name, group_name, filename)
 
     class_dict[meth_name] = blob_set
+    class_dict[meth_name + '_async'] = _blob_async(blob_set)
 
     def blob_set_path(self, name, path):
-        with open(path, 'r') as src:
+        with open(path, 'rb') as src:
             ln = os.fstat(src.fileno()).st_size
             blob = blob_set(self, name, ln, os.path.basename(path))
-            shutil.copyfileobj(src, blob, ln)
+            shutil.copyfileobj(src, blob, BLOB_BUFFER_SIZE)
         return blob.close()
 
     class_dict[meth_name + '_path'] = blob_set_path
+    class_dict[meth_name + '_path_async'] = _blob_async(blob_set_path)
 
 def unwrap_service(service, base, struct, BlobReader, BlobWriter):
     class_name = service.name
@@ -208,8 +390,13 @@ def unwrap_service(service, base, struct, BlobReader, BlobWriter):
             unwrap_blob_get(class_dict, class_name, meth_name, BlobReader)
         elif meth_name.endswith('_set_blob'):
             unwrap_blob_set(class_dict, class_name, meth_name, BlobWriter)
+        elif meth_name in CACHED_METHODS.get(class_name, {}):
+            is_final = CACHED_METHODS[class_name][meth_name]
+            class_dict[meth_name] = unwrap_cached_procedure(proc, is_final)
+            class_dict[meth_name + '_async'] = unwrap_cached_procedure(proc, is_final, True)
         else:
             class_dict[meth_name] = unwrap_procedure(proc)
+            class_dict[meth_name + '_async'] = unwrap_procedure(proc, True)
 
     if struct is not None:
         def __init__(self, _id, _struct=None):
@@ -225,6 +412,7 @@ def unwrap_service(service, base, struct, BlobReader, BlobWriter):
 
         def refresh(self):
             self._struct = self.get_struct()._struct
+            self._cache.clear()
     
         class_dict['__init__'] = __init__
         class_dict['__getattr__'] = __getattr__
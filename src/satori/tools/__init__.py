@@ -2,7 +2,8 @@
 
 from six import print_
 
-from satori.client.common import want_import, remote
+from satori.client.common import want_import, remote, token_cache
+from satori.tools import agent
 from six.moves import configparser
 import getpass
 import logging
@@ -22,6 +23,8 @@ thrift_settings.add_argument('-u', '--username', help='user name (or "-" to skip
 thrift_settings.add_argument('-p', '--password', help='password')
 thrift_settings.add_argument('-m', '--machine', help='machine name (or "-" to skip authentication)')
 thrift_settings.add_argument('-S', '--ssl', help='use SSL', action='store_true')
+thrift_settings.add_argument('--check_idl', help='parse the server interface again instead of using the cached one', action='store_true')
+thrift_settings.add_argument('-A', '--agent', help='run the command in a background agent, started if needed', action='store_true')
 options.add_argument('-l', '--loglevel', type=int, help='Log level (as in logging module in python)')
 
 class AuthSetup:
@@ -37,6 +40,11 @@ class AuthSetup:
         self.machine = None
         self.password = None
         self.ssl = False
+        self.check_idl = False
+        self.agent = False
+
+    def agent_key(self):
+        return agent.agent_key(self.section, self.hostname, self.thrift_port, self.blob_port, self.ssl, self.username, self.machine)
 
     def setup(self):
         if not self.hostname:
@@ -46,35 +54,57 @@ class AuthSetup:
         if not self.blob_port:
             raise RuntimeError('Satori blob port number not specified in config file or arguments')
         logging.debug('Connecting to: {0}:{1}:{2}{3}'.format(self.hostname, self.thrift_port, self.blob_port, ' (SSL)' if self.ssl else ''))
-        remote.setup(self.hostname, self.thrift_port, self.blob_port, self.ssl)
+        remote.setup(self.hostname, self.thrift_port, self.blob_port, self.ssl, self.check_idl)
+
+    def token_path(self):
+        if self.machine:
+            return token_cache.token_path(self.hostname, self.thrift_port, 'machine', self.machine)
+        return token_cache.token_path(self.hostname, self.thrift_port, 'user', self.username)
 
     def authenticate(self):
         if self.machine:
             print_('Machine name: {0}'.format(self.machine))
-            if not self.password:
-                self.password = getpass.getpass('Password: ')
-            try:
-                token_container.set_token(Machine.authenticate(self.machine, self.password))
-            except (TokenInvalid, TokenExpired):
-                token_container.set_token('')
-                token_container.set_token(Machine.authenticate(self.machine, self.password))
         elif self.username != '-':
             if not self.username:
                 self.username = raw_input('User name: ')
                 self.password = None
             else:
                 print_('User name: {0}'.format(self.username))
-            if not self.password:
-                self.password = getpass.getpass('Password: ')
-            try:
-                token_container.set_token(User.authenticate(self.username, self.password))
-            except (TokenInvalid, TokenExpired):
-                token_container.set_token('')
-                token_container.set_token(User.authenticate(self.username, self.password))
+        else:
+            return
+        token = token_cache.read_token(self.token_path())
+        if token is not None:
+            token_container.set_token(token)
+        else:
+            self.login()
+        token_container.set_refresh(self.refresh)
+
+    def login(self):
+        if not self.password:
+            self.password = getpass.getpass('Password: ')
+        if self.machine:
+            login = lambda: Machine.authenticate(self.machine, self.password)
+        else:
+            login = lambda: User.authenticate(self.username, self.password)
+        try:
+            token_container.set_token(login())
+        except (TokenInvalid, TokenExpired):
+            token_container.set_token('')
+            token_container.set_token(login())
+        token_cache.write_token(self.token_path(), token_container.get_token())
+        return token_container.get_token()
+
+    def refresh(self):
+        # called when the server rejects the token during a command
+        token_cache.remove_token(self.token_path())
+        if not self.password and not sys.stdin.isatty():
+            return None
+        token_container.set_token('')
+        return self.login()
 
 auth_setup = AuthSetup()
 
-def setup(log_level=logging.DEBUG):
+def setup(log_level=logging.DEBUG, args=None):
     logger = logging.getLogger()
     logger.setLevel(log_level)
 
@@ -89,7 +119,7 @@ def setup(log_level=logging.DEBUG):
 
     auth_setup.clear()
 
-    option_values = options.parse_args()
+    option_values = options.parse_args(args)
 
     if option_values.config:
         if not os.path.exists(option_values.config):
@@ -135,6 +165,12 @@ def setup(log_level=logging.DEBUG):
         if config.has_option(auth_setup.section, 'ssl'):
             auth_setup.ssl = config.getboolean(auth_setup.section, 'ssl')
 
+        if config.has_option(auth_setup.section, 'check_idl'):
+            auth_setup.check_idl = config.getboolean(auth_setup.section, 'check_idl')
+
+        if config.has_option(auth_setup.section, 'agent'):
+            auth_setup.agent = config.getboolean(auth_setup.section, 'agent')
+
         if config.has_option(auth_setup.section, 'loglevel'):
             logger.setLevel(logging._levelNames[config.get(auth_setup.section, 'loglevel')])
 
@@ -155,15 +191,49 @@ def setup(log_level=logging.DEBUG):
     if option_values.ssl:
         auth_setup.ssl = True
 
+    if option_values.check_idl:
+        auth_setup.check_idl = True
+
+    if option_values.agent:
+        auth_setup.agent = True
+
     if option_values.loglevel:
         logger.setLevel(logging._levelNames[option_values.loglevel])
 
+    if agent.serving():
+        # the agent is connected and authenticated already
+        return option_values
+
+    # only tools dispatching to a command can run it in the agent
+    use_agent = auth_setup.agent and hasattr(option_values, 'command')
+    if use_agent:
+        status = agent.call(auth_setup.agent_key(), sys.argv[1:] if args is None else args)
+        if status is not None:
+            sys.exit(status)
+
     auth_setup.setup()
 
     auth_setup.authenticate()
 
+    if use_agent:
+        agent.start(auth_setup.agent_key(), lambda args: _run_in_agent(log_level, args))
+
     return option_values
 
+def _run_in_agent(log_level, args):
+    option_values = setup(log_level, args)
+    try:
+        option_values.command(option_values)
+    except (TokenInvalid, TokenExpired):
+        # the next command authenticates again and starts a new agent
+        agent.stop()
+        raise
+    except Exception as e:
+        # the server was upgraded since the agent read its interface
+        if remote.is_stale_interface_error(e):
+            agent.stop()
+        raise
+
 def authenticate():
     auth_setup.authenticate()
 
@@ -0,0 +1,347 @@
+# vim:ts=4:sts=4:sw=4:expandtab
+"""Background agent running commands of a tool in a warm process.
+
+The first command run with the agent enabled connects and authenticates as
+usual, and then forks an agent, which keeps the bootstrapped client, its
+token and caches. Later commands with the same connection settings are sent
+to the agent over a Unix socket, with their working directory and the
+terminal and locale settings of their environment, and their output is sent
+back.
+
+The agent runs one command at a time, and exits after AGENT_IDLE_TIMEOUT
+seconds without commands. A command whose client disconnects, e.g. on
+Ctrl-C, is interrupted as Ctrl-C would interrupt it in the client.
+"""
+
+import errno
+import hashlib
+import io
+import logging
+import marshal
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+
+from satori.client.common import remote
+from util import paths
+
+AGENT_IDLE_TIMEOUT = 30 * 60
+
+# a frame is a channel and the length of the data following it
+_HEADER = struct.Struct('!cI')
+_REQUEST = 'r'
+_STDOUT = 'o'
+_STDERR = 'e'
+_EXIT = 'x'
+
+# variables of the client environment the command sees in the agent
+_FORWARDED_ENV = ('TERM', 'COLUMNS', 'LINES', 'LANG', 'LANGUAGE')
+_FORWARDED_ENV_PREFIXES = ('LC_', 'XDG_')
+
+_serving = False
+_stopping = False
+
+
+def serving():
+    """Tells whether the calling process is the agent."""
+    return _serving
+
+
+def stop():
+    """Makes the agent exit after the current command."""
+    global _stopping
+    _stopping = True
+
+
+def agent_key(*settings):
+    """Identifies the agent serving the given connection settings.
+
+    The key depends also on the tool, so that a rebuilt tool does not use an
+    agent running the old code.
+    """
+    program = os.path.realpath(sys.argv[0])
+    try:
+        mtime = os.path.getmtime(program)
+    except OSError:
+        mtime = None
+    return hashlib.sha1(repr((program, mtime) + settings)).hexdigest()[:16]
+
+
+def socket_path(key):
+    return paths.cache_path('agent', key + '.sock')
+
+
+def _send(sock, channel, data):
+    sock.sendall(_HEADER.pack(channel, len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv(sock):
+    (channel, size) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return (channel, _recv_exactly(sock, size))
+
+
+def _forwarded_env():
+    return dict((name, value) for (name, value) in os.environ.items()
+            if name in _FORWARDED_ENV or name.startswith(_FORWARDED_ENV_PREFIXES))
+
+
+def _set_forwarded_env(env):
+    """Sets the forwarded variables to env, and returns their previous values."""
+    previous = _forwarded_env()
+    for name in previous:
+        if name not in env:
+            del os.environ[name]
+    os.environ.update(env)
+    return previous
+
+
+def call(key, args):
+    """Runs a command in the agent.
+
+    Returns the exit status of the command, or None if no agent is running.
+    """
+    path = socket_path(key)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno == errno.ECONNREFUSED:
+            # left by an agent that did not exit cleanly
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        elif e.errno != errno.ENOENT:
+            logging.warning('Cannot connect to the agent at %s: %s', path, e)
+        return None
+
+    logging.debug('Running the command in the agent at %s', path)
+    streams = {_STDOUT: sys.stdout, _STDERR: sys.stderr}
+    try:
+        _send(sock, _REQUEST, marshal.dumps((list(args), os.getcwd(), _forwarded_env())))
+        while True:
+            try:
+                (channel, data) = _recv(sock)
+            except EOFError:
+                raise RuntimeError('The agent exited before the command finished')
+            if channel == _EXIT:
+                return int(data)
+            stream = streams.get(channel)
+            if stream is None:
+                logging.debug('Ignoring output of the agent on channel %r', channel)
+                continue
+            stream.write(data)
+            stream.flush()
+    finally:
+        sock.close()
+
+
+class _Stream(object):
+    """Output stream sending what is written to the client of the agent."""
+
+    def __init__(self, sock, lock, channel):
+        self._sock = sock
+        self._lock = lock
+        self._channel = channel
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            with self._lock:
+                _send(self._sock, self._channel, data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        raise io.UnsupportedOperation('fileno')
+
+
+def _exit_status(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print >>sys.stderr, code
+    return 1
+
+
+def _redirect_log_handlers(streams):
+    """Points log handlers writing to a stream to its replacement.
+
+    Handlers keep the stream they were created with, which would otherwise
+    be the output of the command they were set up in.
+    """
+    for handler in logging.getLogger().handlers:
+        stream = getattr(handler, 'stream', None)
+        if stream in streams:
+            handler.stream = streams[stream]
+
+
+class _ClientWatch(object):
+    """Interrupts the command when its client disconnects before it ends."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._lock = threading.Lock()
+        self._running = True
+        thread = threading.Thread(target=self._watch)
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self):
+        try:
+            # the client sends nothing after the request
+            self._sock.recv(1)
+        except socket.error:
+            pass
+        with self._lock:
+            if self._running:
+                os.kill(os.getpid(), signal.SIGINT)
+
+    def finish(self):
+        try:
+            with self._lock:
+                self._running = False
+        except KeyboardInterrupt:
+            # sent just before the command ended
+            pass
+
+
+def _serve_request(sock, run):
+    (channel, data) = _recv(sock)
+    if channel != _REQUEST:
+        return
+    (args, cwd, env) = marshal.loads(data)
+    lock = threading.Lock()
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    sys.stdout = _Stream(sock, lock, _STDOUT)
+    sys.stderr = _Stream(sock, lock, _STDERR)
+    _redirect_log_handlers({stdout: sys.stdout, stderr: sys.stderr})
+    watch = _ClientWatch(sock)
+    agent_env = _set_forwarded_env(env)
+    try:
+        try:
+            os.chdir(cwd)
+            run(args)
+            status = 0
+        except SystemExit as e:
+            status = _exit_status(e.code)
+        except KeyboardInterrupt:
+            # interrupted when the client disconnected
+            status = 130
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            watch.finish()
+    finally:
+        _set_forwarded_env(agent_env)
+        _redirect_log_handlers({sys.stdout: stdout, sys.stderr: stderr})
+        (sys.stdout, sys.stderr) = (stdout, stderr)
+    _send(sock, _EXIT, str(status))
+
+
+def _listen(path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    # bound under a temporary name and renamed, so that clients never see
+    # a socket which does not accept connections yet
+    temporary = '{0}.{1}'.format(path, os.getpid())
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(temporary):
+        os.unlink(temporary)
+    listener.bind(temporary)
+    os.chmod(temporary, 0o600)
+    listener.listen(16)
+    os.rename(temporary, path)
+    return listener
+
+
+def _serve(path, run):
+    global _serving
+    _serving = True
+    listener = _listen(path)
+    identity = os.stat(path).st_ino
+    listener.settimeout(AGENT_IDLE_TIMEOUT)
+    try:
+        while not _stopping:
+            try:
+                (sock, _) = listener.accept()
+            except socket.timeout:
+                break
+            sock.settimeout(None)
+            try:
+                _serve_request(sock, run)
+            except (socket.error, EOFError, KeyboardInterrupt):
+                # the client went away
+                pass
+            finally:
+                try:
+                    # wakes up the thread watching the client
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                sock.close()
+    finally:
+        listener.close()
+        try:
+            # another agent may have replaced the socket in the meantime
+            if os.stat(path).st_ino == identity:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+def start(key, run):
+    """Forks an agent serving commands with the given key.
+
+    The agent calls run with the arguments of each command. It must be
+    started while the calling process has a single thread.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        # forks again, so that the agent is not a child of the command
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        remote.reset_connections()
+        _serve(socket_path(key), run)
+    except:
+        logging.exception('The agent failed')
+    finally:
+        os._exit(0)
@@ -1,47 +1,286 @@
 # vim:ts=4:sts=4:sw=4:et
 import base64
 import collections
-import hashlib
+import logging
 import os.path
 import six
+import socket
 import sys
-import yaml
+import threading
+from six.moves import http_client
+from multiprocessing.pool import ThreadPool
 
-from util import blob, ctxyaml
+from util import blob, hashcache, paths
 from util.nsdict import NamespaceDict
 
 from satori.client.common import want_import
 want_import(globals(), '*')
 
+from satori.client.common import remote as remote_client
+from satori.client.common.unwrap import cache_results
 
-def copy_file(src, dst):
-    BUF_SIZ = 16 * 1024
+
+# data of a temporary submit never changes, and its results are written at
+# once, when testing finishes
+cache_results('TemporarySubmit', 'test_data_get_map')
+cache_results('TemporarySubmit', 'test_data_get_list')
+cache_results('TemporarySubmit', 'submit_data_get_map')
+cache_results('TemporarySubmit', 'submit_data_get_list')
+cache_results('TemporarySubmit', 'result_get_map', bool)
+cache_results('TemporarySubmit', 'result_get_list', bool)
+
+
+BUFFER_SIZE = 1024 * 1024
+TRANSFER_RETRIES = 3
+
+# errors of a BLOB transfer interrupted by the network
+TRANSFER_ERRORS = (socket.error, http_client.HTTPException)
+
+
+def copy_file(src, dst, buffer_size=BUFFER_SIZE, progress=None):
+    """Copies a stream buffer_size bytes at a time.
+
+    progress is called with the number of bytes copied so far after every
+    chunk. Returns the number of bytes copied.
+    """
+    copied = 0
     while True:
-        buf = src.read(BUF_SIZ)
+        buf = src.read(buffer_size)
         if not buf:
             break
         dst.write(buf)
+        copied += len(buf)
+        if progress is not None:
+            progress(copied)
+    return copied
+
+
+def upload_file(blob_path, buffer_size=BUFFER_SIZE, progress=None,
+        retries=TRANSFER_RETRIES):
+    """Uploads a file as a BLOB and returns its hash.
+
+    The server cannot continue an interrupted upload, so an upload failing
+    on a network error is started again, at most retries times.
+    progress is called with the number of bytes and the size of the file.
+    """
+    blob_size = os.path.getsize(blob_path)
+    report = None
+    if progress is not None:
+        report = lambda copied: progress(copied, blob_size)
+    attempt = 0
+    while True:
+        try:
+            with open(blob_path, 'rb') as local_blob:
+                remote_blob = Blob.create(blob_size)
+                copy_file(local_blob, remote_blob, buffer_size, report)
+            return remote_blob.close()
+        except TRANSFER_ERRORS:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logging.warning('Upload of %s interrupted, retrying', blob_path, exc_info=True)
+
+
+def _download_part(blob_hash, part_path, buffer_size, progress, retries):
+    attempt = 0
+    while True:
+        offset = 0
+        if os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+        try:
+            remote_blob = Blob.open(blob_hash, offset)
+            try:
+                offset = remote_blob.offset
+                blob_size = offset + remote_blob.length
+                report = None
+                if progress is not None:
+                    report = lambda copied: progress(offset + copied, blob_size)
+                with open(part_path, 'ab' if offset else 'wb') as local_blob:
+                    copied = copy_file(remote_blob, local_blob, buffer_size, report)
+            finally:
+                remote_blob.close()
+            if offset + copied != blob_size:
+                raise http_client.IncompleteRead('', blob_size - offset - copied)
+            return
+        except TRANSFER_ERRORS:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logging.warning('Download of %s interrupted, retrying', part_path, exc_info=True)
+
+
+def download_blob(blob_hash, path, buffer_size=BUFFER_SIZE, progress=None,
+        retries=TRANSFER_RETRIES):
+    """Downloads a BLOB to a file.
+
+    The content is written to a partial file next to path first, named after
+    the BLOB, as different BLOBs may be downloaded to the same path. An
+    interrupted download, in this or a previous run, continues from the end
+    of the partial file, when the server supports range requests. A partial
+    file which turns out not to hold the BLOB is removed, and the download
+    starts over once.
+    progress is called with the number of bytes and the size of the BLOB.
+    """
+    part_path = '%s.%s.part' % (path, blob_hash)
+    restarted = False
+    while True:
+        try:
+            _download_part(blob_hash, part_path, buffer_size, progress, retries)
+        except remote_client.RangeNotSatisfiable:
+            # the partial file is complete already, or longer than the BLOB
+            pass
+        if _calculate_blob_hash(part_path) == blob_hash:
+            break
+        os.remove(part_path)
+        if restarted:
+            raise RuntimeError('Hash mismatch after downloading %s' % path)
+        restarted = True
+        logging.warning('Partial download of %s is corrupt, starting over', path)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(part_path, path)
 
 
 def _calculate_blob_hash(blob_path):
-    with open(blob_path, 'rb') as blob:
-        # TODO: use a buffer to avoid unbounded memory usage
-        return base64.urlsafe_b64encode(hashlib.sha384(blob.read()).digest())
+    (blob_hash,) = hashcache.file_digests(blob_path, ['sha384'])
+    return base64.urlsafe_b64encode(blob_hash)
+
+
+class _Pool(ThreadPool):
+    """Pool of worker threads, each with a Thrift connection reserved.
+
+    The connections are given back once the pool is joined or terminated.
+    """
+
+    def __init__(self, jobs, connections):
+        ThreadPool.__init__(self, jobs)
+        self._reserved = connections
+        self._reserved_lock = threading.Lock()
+        remote_client.reserve_connections(connections)
+
+    def _release_connections(self):
+        with self._reserved_lock:
+            (connections, self._reserved) = (self._reserved, 0)
+        if connections:
+            remote_client.release_connections(connections)
+
+    def join(self):
+        ThreadPool.join(self)
+        self._release_connections()
+
+    def terminate(self):
+        ThreadPool.terminate(self)
+        self._release_connections()
+
+
+def make_pool(jobs, calls=True):
+    """Creates a pool of worker threads.
+
+    Workers share the token and the Thrift connections of the process. Unless
+    calls is False, because the workers do not call the server, a connection
+    is reserved for every worker.
+    """
+    return _Pool(jobs, jobs if calls else 0)
+
+
+def server_name():
+    """Identifies the server the client is connected to."""
+    return '%s:%d' % (remote_client.client_host, remote_client.client_port)
+
+
+class KnownBlobs(hashcache.SharedDatabase):
+    """Hashes of BLOBs known to be stored on each server.
+
+    BLOBs are addressed by their content, so once a BLOB was found on
+    a server, checking for it again is not needed.
+    """
+
+    schema = '''CREATE TABLE IF NOT EXISTS blobs (
+        server TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (server, hash))'''
+
+    # stays below the SQLite limit on the number of query parameters
+    QUERY_SIZE = 500
+
+    def known(self, server, blob_hashes):
+        blob_hashes = list(blob_hashes)
+        connection = self._connection()
+        found = set()
+        for start in range(0, len(blob_hashes), self.QUERY_SIZE):
+            chunk = blob_hashes[start:start + self.QUERY_SIZE]
+            rows = connection.execute(
+                'SELECT hash FROM blobs WHERE server = ? AND hash IN (%s)' % ', '.join('?' * len(chunk)),
+                [server] + chunk).fetchall()
+            found.update(str(blob_hash) for (blob_hash,) in rows)
+        return found
+
+    def add(self, server, blob_hashes):
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO blobs (server, hash) VALUES (?, ?)',
+                [(server, blob_hash) for blob_hash in blob_hashes])
+
+
+_known_blobs = None
+_known_blobs_lock = threading.Lock()
+
+def known_blobs():
+    global _known_blobs
+    with _known_blobs_lock:
+        if _known_blobs is None and hashcache.sqlite3 is not None:
+            _known_blobs = KnownBlobs(paths.cache_path('blobs.sqlite'))
+    return _known_blobs
+
+
+def remember_blobs(blob_hashes):
+    """Records that BLOBs are stored on the server."""
+    store = known_blobs()
+    if store is None:
+        return
+    try:
+        store.add(server_name(), blob_hashes)
+    except (hashcache.sqlite3.Error, EnvironmentError):
+        logging.debug('Failed to record known BLOBs', exc_info=True)
+
+
+def missing_blobs(blob_hashes, use_known=True):
+    """Returns the set of blob_hashes not stored on the server.
+
+    BLOBs remembered from previous checks and uploads are not checked again,
+    unless use_known is False. The others are checked in one batch of
+    pipelined calls.
+    """
+    blob_hashes = set(blob_hashes)
+    known = set()
+    store = known_blobs()
+    if store is not None and use_known:
+        try:
+            known = store.known(server_name(), blob_hashes)
+        except (hashcache.sqlite3.Error, EnvironmentError):
+            logging.debug('Failed to look up known BLOBs', exc_info=True)
+    unknown = sorted(blob_hashes - known)
+    if not unknown:
+        return set()
+    exists = Blob.exists.call_many([(blob_hash,) for blob_hash in unknown])
+    remember_blobs([blob_hash for (blob_hash, found) in zip(unknown, exists) if found])
+    return set(blob_hash for (blob_hash, found) in zip(unknown, exists) if not found)
 
 
-def upload_blob(blob_path):
+def upload_blob(blob_path, out=None):
+    if out is None:
+        out = sys.stdout
     blob_hash = _calculate_blob_hash(blob_path)
-    if not Blob.exists(blob_hash):
-        with open(blob_path, 'rb') as local_blob:
-            blob_size = os.path.getsize(blob_path)
-            remote_blob = Blob.create(blob_size)
-            print 'Uploading blob', os.path.basename(blob_path) + ',',
-            print 'size =', blob_size, 'bytes' + '...',
-            sys.stdout.flush()
-            copy_file(local_blob, remote_blob)
-            print 'done'
-        remote_blob_hash = remote_blob.close()
+    if missing_blobs([blob_hash]):
+        blob_size = os.path.getsize(blob_path)
+        print >>out, 'Uploading blob', os.path.basename(blob_path) + ',',
+        print >>out, 'size =', blob_size, 'bytes' + '...',
+        out.flush()
+        remote_blob_hash = upload_file(blob_path)
+        print >>out, 'done'
         assert blob_hash == remote_blob_hash
+        remember_blobs([blob_hash])
     blob_name = os.path.basename(blob_path)
     return AnonymousAttribute(is_blob=True, value=blob_hash, filename=blob_name)
 
@@ -62,9 +301,10 @@ def simplify(value):
 def serialize(value):
     if isinstance(value, simple_types):
         return str(value)
+    import yaml
     return str(yaml.safe_dump(simplify(value)))
 
-def make_test_data(test_pair, include_name_in_data=False):
+def make_test_data(test_pair, include_name_in_data=False, out=None, uploader=None):
     test_name, test_yaml = test_pair
     test_yaml['name'] = test_name
     test_data = {}
@@ -72,8 +312,10 @@ def make_test_data(test_pair, include_name_in_data=False):
         key = str(key)
         if key == 'name' and not include_name_in_data:
             continue
-        if type(value) == blob.Blob:
-            test_data[key] = upload_blob(value.path)
+        if type(value) == blob.Blob and uploader is not None:
+            test_data[key] = uploader.submit(value.path, out or sys.stdout)
+        elif type(value) == blob.Blob:
+            test_data[key] = upload_blob(value.path, out)
         else:
             test_data[key] = AnonymousAttribute(is_blob = False, value = serialize(value))
     return test_data
@@ -0,0 +1,86 @@
+# vim:ts=4:sts=4:sw=4:et
+import hashlib
+import json
+import os
+import threading
+import time
+
+from util import blob
+
+from testing.common import dict_types, list_types, simple_types
+
+
+def _canonical(value):
+    if isinstance(value, blob.Blob):
+        return ['!file', value.basename, value.getdigest()]
+    if isinstance(value, dict_types):
+        return sorted([[_canonical(key), _canonical(val)]
+            for (key, val) in value.items()])
+    if isinstance(value, list_types):
+        return [_canonical(element) for element in value]
+    if value is None or isinstance(value, simple_types):
+        return value
+    return str(value)
+
+
+def digest(*values):
+    """Computes a digest of local sync inputs.
+
+    BLOBs contribute their name and content digest, so editing a file
+    referenced by the mapping changes the digest of everything using it.
+    """
+    return hashlib.sha1(json.dumps(_canonical(list(values)),
+        sort_keys=True)).hexdigest()
+
+
+def manifest_path(mapping_path):
+    return mapping_path + '.sync'
+
+
+class SyncManifest(object):
+    """Remote ids and local input digests recorded by previous syncs.
+
+    Entries are kept separately for every server the mapping was synced to.
+    An entry states that the remote object with the given id holds exactly
+    the local inputs with the given digest.
+    """
+
+    def __init__(self, path, server, verify=False):
+        self.path = path
+        self.server = server
+        self.verify = verify
+        self._lock = threading.Lock()
+        self._servers = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as manifest_file:
+                    self._servers = json.load(manifest_file)
+            except ValueError:
+                self._servers = {}
+        self._entries = self._servers.setdefault(server, {})
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def lookup(self, key, input_digest):
+        """Returns the remote id recorded for unchanged inputs, or None."""
+        if self.verify:
+            return None
+        entry = self.get(key)
+        if entry is not None and entry['digest'] == input_digest:
+            return entry['id']
+        return None
+
+    def record(self, key, remote_id, input_digest, **kwargs):
+        entry = dict(kwargs)
+        entry.update(id=remote_id, digest=input_digest, synced=int(time.time()))
+        with self._lock:
+            self._entries[key] = entry
+
+    def save(self):
+        with self._lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as manifest_file:
+                json.dump(self._servers, manifest_file, indent=1, sort_keys=True)
+            os.rename(temp_path, self.path)
@@ -4,7 +4,7 @@ import os.path
 from satori.client.common import want_import
 want_import(globals(), '*')
 
-from testing.common import copy_file, upload_blob
+from testing.common import download_blob, upload_blob
 
 def render_statement(opts):
     with open(opts.STATEMENT) as f:
@@ -13,6 +13,4 @@ def render_statement(opts):
     for attachment in opts.ATTACHMENTS:
         attachments[os.path.basename(attachment)] = upload_blob(attachment)
     out_hash = ProblemStatementUtils.render_to_pdf(statement, attachments)
-    out_remote = Blob.open(out_hash)
-    with open(opts.OUTPUT, "w") as out_local:
-        copy_file(out_remote, out_local)
+    download_blob(out_hash, opts.OUTPUT)
@@ -1,15 +1,15 @@
 # vim:ts=4:sts=4:sw=4:et
 import os
 import sys
-import time
 import traceback
-
-from util import ctxyaml
+from six import StringIO
 
 from satori.client.common import want_import
 want_import(globals(), '*')
 
-from testing.common import copy_file, make_test_data, upload_blob
+from testing.common import make_pool, make_test_data, server_name
+from testing.manifest import SyncManifest, digest, manifest_path
+from testing.upload import BlobUploader, DEFAULT_MAX_IN_FLIGHT, wait_test_data
 
 
 def normalize_keys(keys):
@@ -31,9 +31,238 @@ def map_has_changed(local_map, remote_map):
         if normalize_val(local_val) != normalize_val(remote_val):
             return True
     return False
-  
+
+
+def _grant_manage(contest, entity, out):
+    try:
+        Privilege.grant(contest.admin_role, entity, 'MANAGE', None)
+    except:
+        traceback.print_exc(file=out)
+        pass
+
+
+class RemoteProblem(object):
+    """Remote tests and test suites of a problem, indexed by name.
+
+    Everything needed to diff a problem is fetched in one pass, instead of
+    looking up each test separately. Tests listed in unchanged_tests (name
+    to remote id) are known to be up to date and are not fetched at all.
+    """
+
+    def __init__(self, problem=None, test_names=(), pool_map=map,
+            unchanged_tests={}):
+        self.tests = dict((name, None) for name in test_names
+                if name not in unchanged_tests)
+        self.unchanged_tests = unchanged_tests
+        self.test_maps = {}
+        self.problem = problem
+        self._suites = None
+        if problem is None or not self.tests:
+            return
+        for test in Test.filter(TestStruct(problem=problem)):
+            if test.name in self.tests and self.tests[test.name] is None:
+                self.tests[test.name] = test
+        tests = [test for test in self.tests.values() if test is not None]
+        maps = Test.data_get_map.call_many([(test,) for test in tests], pool_map)
+        for (test, data_map) in zip(tests, maps):
+            self.test_maps[test.name] = data_map
+
+    def suite(self, name):
+        if self._suites is None:
+            self._suites = {}
+            if self.problem is not None:
+                for suite in TestSuite.filter(TestSuiteStruct(problem=self.problem)):
+                    self._suites.setdefault(suite.name, suite)
+        return self._suites.get(name)
+
+
+def _sync_test(contest, problem, remote, test_name, test_data, out):
+    if test_name not in remote.tests:
+        # unchanged since the last sync
+        return Test(remote.unchanged_tests[test_name])
+    test_data = wait_test_data(test_data)
+    test = remote.tests[test_name]
+    if test is None:
+        print >>out, " Test %s does not exist, creating" % test_name
+        test = Test.create(
+                TestStruct(name=test_name, problem=problem),
+                test_data)
+    else:
+        if map_has_changed(test_data, remote.test_maps[test_name]):
+            print >>out, " Test %s exists but has changed, updating" % test_name
+            test = test.modify_full(
+                    TestStruct(name=test_name, problem=problem),
+                    test_data)
+    _grant_manage(contest, test, out)
+    return test
+
+
+def _sync_problem(contest, mapping, prefix, problem_key, problem_value,
+        manifest, uploader, test_pool=None, out=None):
+    if out is None:
+        out = sys.stdout
+    problem_digest = digest(mapping.common, problem_key, problem_value)
+    if manifest.lookup('problem:%s' % problem_key, problem_digest) is not None:
+        print >>out, "Problem %s has not changed since last sync" % problem_key
+        return
+    print >>out, "Syncing problem %s" % problem_key
+    problem_name = '[' + prefix + '] ' + problem_key
+    pool_map = map if test_pool is None else test_pool.map
+    test_digests = dict((test_name, digest(problem_name, test_name, test_yaml))
+            for (test_name, test_yaml) in problem_value.tests.items())
+    problem_entry = manifest.get('problem:%s' % problem_key)
+    if (not manifest.verify and problem_entry is not None and
+            problem_entry['name'] == problem_name):
+        problem = [Problem(problem_entry['id'])]
+    else:
+        problem = Problem.filter(ProblemStruct(name=problem_name))
+    if not problem:
+        print >>out, " Problem %s does not exist, creating new problem" % problem_name
+        problem = Problem.create(ProblemStruct(name=problem_name))
+        remote = RemoteProblem(test_names=problem_value.tests.keys())
+    else:
+        problem = problem[0]
+        unchanged_tests = {}
+        for (test_name, test_digest) in test_digests.items():
+            test_id = manifest.lookup(
+                    'test:%s/%s' % (problem_key, test_name), test_digest)
+            if test_id is not None:
+                unchanged_tests[test_name] = test_id
+        remote = RemoteProblem(problem, problem_value.tests.keys(), pool_map,
+                unchanged_tests)
+    _grant_manage(contest, problem, out)
+    # uploads of all tests start before the first test is synced
+    test_outs = {}
+    test_datas = {}
+    for test_pair in problem_value.tests.items():
+        test_name = test_pair[0]
+        if test_name in remote.tests:
+            test_outs[test_name] = out if test_pool is None else StringIO()
+            test_datas[test_name] = make_test_data(test_pair,
+                    out=test_outs[test_name], uploader=uploader)
+    test_names = list(problem_value.tests.keys())
+    tests = pool_map(lambda test_name: _sync_test(contest, problem, remote,
+        test_name, test_datas.get(test_name), test_outs.get(test_name)),
+        test_names)
+    for (test_name, test) in zip(test_names, tests):
+        if test_pool is not None and test_name in test_outs:
+            out.write(test_outs[test_name].getvalue())
+        manifest.record('test:%s/%s' % (problem_key, test_name), test._id,
+                test_digests[test_name])
+    dispatcher = problem_value.get('dispatcher', mapping.common.dispatcher)
+    reporter   = problem_value.get('reporter', mapping.common.reporter)
+    suite_struct = TestSuiteStruct(
+            problem=problem,
+            name='tests',
+            dispatcher=dispatcher,
+            reporter=reporter,
+            accumulators='')
+    suite_params = {}
+    for key in mapping.common:
+        if key[:len(reporter)] == reporter:
+            suite_params[key] = AnonymousAttribute(
+                    value=mapping.common[key], is_blob=False)
+    for key in problem_value:
+        if key[:len(reporter)] == reporter:
+            suite_params[key] = AnonymousAttribute(
+                    value=problem_value[key], is_blob=False)
+    test_params = [{} for _ in tests]
+    suite_digest = digest(problem._id, dispatcher, reporter,
+            dict((key, attr.value) for (key, attr) in suite_params.items()),
+            [test._id for test in tests])
+    suite_id = manifest.lookup('suite:%s' % problem_key, suite_digest)
+    if suite_id is not None:
+        suite = TestSuite(suite_id)
+    elif remote.suite('tests') is None:
+        print >>out, " Test suite does not exist, creating"
+        suite = TestSuite.create(suite_struct, suite_params, tests, test_params)
+    else:
+        suite = remote.suite('tests')
+        if (suite.dispatcher != suite_struct.dispatcher or
+            suite.reporter != suite_struct.reporter or
+            suite.accumulators != suite_struct.accumulators or
+            map_has_changed(suite_params, suite.params_get_map()) or
+            [t.name for t in suite.get_tests()] != test_names):
+            print >>out, " Test suite exists but has changed, updating"
+            suite = suite.modify_full(suite_struct, suite_params, tests,
+                    test_params)
+    if suite_id is None:
+        _grant_manage(contest, suite, out)
+        manifest.record('suite:%s' % problem_key, suite._id, suite_digest)
+    attachments = []
+    if 'logos' in mapping.common:
+        attachments += mapping.common.logos
+    if 'attachments' in problem_value:
+        attachments += problem_value.attachments
+    statement = problem_value.statement.getvalue()
+
+    header = problem_value.name
+    if header not in statement:
+        print >>out, " WARNING: Problem statement does not contain '%s'" % header
+
+    group = problem_value.group if 'group' in problem_value else ''
+    mapping_digest = digest(contest._id, problem._id, problem_key,
+            problem_value.name, suite._id, group, statement, attachments)
+    mapping_id = manifest.lookup('mapping:%s' % problem_key, mapping_digest)
+    if mapping_id is None:
+        mapping_id = _sync_problem_mapping(contest, problem, suite, problem_key,
+                problem_value, group, statement, attachments, out)
+        manifest.record('mapping:%s' % problem_key, mapping_id, mapping_digest)
+    manifest.record('problem:%s' % problem_key, problem._id, problem_digest,
+            name=problem_name)
+
+
+def _sync_problem_mapping(contest, problem, suite, problem_key, problem_value,
+        group, statement, attachments, out):
+    problem_mapping = ProblemMapping.filter(ProblemMappingStruct(
+        contest=contest, code=problem_key))
+    problem_mapping_struct = ProblemMappingStruct(
+            contest=contest, problem=problem, code=problem_key,
+            title=problem_value.name, default_test_suite=suite,
+            group=group)
+    if not problem_mapping:
+        print >>out, " Problem mapping does not exist, creating"
+        problem_mapping = ProblemMapping.create(problem_mapping_struct)
+        for attachment in attachments:
+            path = attachment.path
+            problem_mapping.statement_files_set_blob_path(
+                    os.path.basename(path), path)
+        try:
+            problem_mapping.statement = statement
+        except SphinxException as sphinx_exception:
+            print >>out, sphinx_exception
+    else:
+        problem_mapping = problem_mapping[0]
+        if (problem_mapping.problem != problem_mapping_struct.problem or
+            problem_mapping.title != problem_mapping_struct.title or
+            problem_mapping.default_test_suite != problem_mapping_struct.default_test_suite or
+            problem_mapping.statement != statement or
+            problem_mapping.group != problem_mapping_struct.group):
+            print >>out, " Problem mapping exists but has changed, updating"
+            problem_mapping = problem_mapping.modify(problem_mapping_struct)
+            for attachment in attachments:
+                path = attachment.path
+                problem_mapping.statement_files_set_blob_path(
+                        os.path.basename(path), path)
+            try:
+                problem_mapping.statement = statement
+            except SphinxException as sphinx_exception:
+                print >>out, sphinx_exception
+    return problem_mapping._id
+
+
+def sync_options(parser):
+    """Adds the options of the sync command to parser."""
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--verify', action='store_const', const=True, default=False)
+    parser.add_argument('--max_in_flight', type=int,
+            default=DEFAULT_MAX_IN_FLIGHT / (1024 * 1024),
+            help='megabytes of BLOBs uploaded at the same time')
+
 
 def sync(opts):
+    from util import ctxyaml
+
     with open(opts.MAPPING) as mapping_file:
         mapping = ctxyaml.load(mapping_file)
 
@@ -47,123 +276,52 @@ def sync(opts):
     else:
         prefix = mapping.common.contest
 
-    for problem_key, problem_value in mapping.problems.items():
-        print "Syncing problem %s" % problem_key
-        problem_name = '[' + prefix + '] ' + problem_key
-        problem = Problem.filter(ProblemStruct(name=problem_name))
-        if not problem:
-            print " Problem %s does not exist, creating new problem" % problem_name
-            problem = Problem.create(ProblemStruct(name=problem_name))
-        else:
-            problem = problem[0]
-        try:
-            Privilege.grant(contest.admin_role, problem, 'MANAGE', None)
-        except:
-            traceback.print_exc()
-            pass
-        tests = []
-        for test_pair in problem_value.tests.items():
-            test_name = test_pair[0]
-            test_data = make_test_data(test_pair)
-            test = Test.filter(TestStruct(name=test_name, problem=problem))
-            if not test:
-                print " Test %s does not exist, creating" % test_name
-                test = Test.create(
-                        TestStruct(name=test_name, problem=problem),
-                        test_data)
-            else:
-                test = test[0]
-                if map_has_changed(test_data, test.data_get_map()):
-                    print " Test %s exists but has changed, updating" % test_name
-                    test = test.modify_full(
-                            TestStruct(name=test_name, problem=problem),
-                            test_data)
+    manifest = SyncManifest(manifest_path(opts.MAPPING), server_name(),
+            opts.verify)
+
+    with BlobUploader(opts.jobs, opts.max_in_flight * 1024 * 1024,
+            opts.verify) as uploader:
+        _sync_problems(contest, mapping, prefix, manifest, uploader, opts.jobs)
+
+
+def _sync_problems(contest, mapping, prefix, manifest, uploader, jobs):
+    if jobs <= 1:
+        for problem_key, problem_value in mapping.problems.items():
             try:
-                Privilege.grant(contest.admin_role, test, 'MANAGE', None)
-            except:
-                traceback.print_exc()
-                pass
-            tests.append(test)
-        suite = TestSuite.filter(TestSuiteStruct(problem=problem, name='tests'))
-        dispatcher = problem_value.get('dispatcher', mapping.common.dispatcher)
-        reporter   = problem_value.get('reporter', mapping.common.reporter)
-        suite_struct = TestSuiteStruct(
-                problem=problem,
-                name='tests',
-                dispatcher=dispatcher,
-                reporter=reporter,
-                accumulators='')
-        suite_params = {}
-        for key in mapping.common:
-            if key[:len(reporter)] == reporter:
-                suite_params[key] = AnonymousAttribute(
-                        value=mapping.common[key], is_blob=False)
-        for key in problem_value:
-            if key[:len(reporter)] == reporter:
-                suite_params[key] = AnonymousAttribute(
-                        value=problem_value[key], is_blob=False)
-        test_params = [{} for _ in tests]
-        if not suite:
-            print " Test suite does not exist, creating"
-            suite = TestSuite.create(suite_struct, suite_params, tests, test_params)
-        else:
-            suite = suite[0]
-            if (suite.dispatcher != suite_struct.dispatcher or
-                suite.reporter != suite_struct.reporter or
-                suite.accumulators != suite_struct.accumulators or
-                map_has_changed(suite_params, suite.params_get_map()) or
-                [t.name for t in suite.get_tests()] != [t.name for t in tests]):
-                print " Test suite exists but has changed, updating"
-                suite = suite.modify_full(suite_struct, suite_params, tests,
-                        test_params)
+                _sync_problem(contest, mapping, prefix, problem_key,
+                        problem_value, manifest, uploader)
+            finally:
+                manifest.save()
+        return
+
+    # Problems are synced by one pool and their tests by another, so that
+    # a problem waiting for its tests never occupies a worker they need.
+    problem_pool = make_pool(jobs)
+    test_pool = make_pool(jobs)
+
+    def sync_problem(problem_item):
+        (problem_key, problem_value) = problem_item
+        out = StringIO()
         try:
-            Privilege.grant(contest.admin_role, suite, 'MANAGE', None)
+            _sync_problem(contest, mapping, prefix, problem_key, problem_value,
+                    manifest, uploader, test_pool, out)
+            return (problem_key, out.getvalue(), False)
         except:
-            traceback.print_exc()
-            pass
-        attachments = []
-        if 'logos' in mapping.common:
-            attachments += mapping.common.logos
-        if 'attachments' in problem_value:
-            attachments += problem_value.attachments
-        statement = problem_value.statement.getvalue()
-
-        header = problem_value.name
-        if header not in statement:
-            print " WARNING: Problem statement does not contain '%s'" % header
-
-        problem_mapping = ProblemMapping.filter(ProblemMappingStruct(
-            contest=contest, code=problem_key))
-        group = problem_value.group if 'group' in problem_value else ''
-        problem_mapping_struct = ProblemMappingStruct(
-                contest=contest, problem=problem, code=problem_key,
-                title=problem_value.name, default_test_suite=suite,
-                group=group)
-        if not problem_mapping:
-            print " Problem mapping does not exist, creating"
-            problem_mapping = ProblemMapping.create(problem_mapping_struct)
-            for attachment in attachments:
-                path = attachment.path
-                problem_mapping.statement_files_set_blob_path(
-                        os.path.basename(path), path)
-            try:
-                problem_mapping.statement = statement
-            except SphinxException as sphinx_exception:
-                print sphinx_exception
-        else:
-            problem_mapping = problem_mapping[0]
-            if (problem_mapping.problem != problem_mapping_struct.problem or
-                problem_mapping.title != problem_mapping_struct.title or
-                problem_mapping.default_test_suite != problem_mapping_struct.default_test_suite or
-                problem_mapping.statement != statement or
-                problem_mapping.group != problem_mapping_struct.group):
-                print " Problem mapping exists but has changed, updating"
-                problem_mapping = problem_mapping.modify(problem_mapping_struct)
-                for attachment in attachments:
-                    path = attachment.path
-                    problem_mapping.statement_files_set_blob_path(
-                            os.path.basename(path), path)
-                try:
-                    problem_mapping.statement = statement
-                except SphinxException as sphinx_exception:
-                    print sphinx_exception
+            traceback.print_exc(file=out)
+            return (problem_key, out.getvalue(), True)
+        finally:
+            manifest.save()
+
+    failed = []
+    try:
+        for (problem_key, output, error) in problem_pool.imap_unordered(
+                sync_problem, mapping.problems.items()):
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if error:
+                failed.append(problem_key)
+    finally:
+        problem_pool.terminate()
+        test_pool.terminate()
+    if failed:
+        raise RuntimeError('Failed to sync problems: %s' % ', '.join(failed))
@@ -1,44 +1,94 @@
 # vim:ts=4:sts=4:sw=4:et
+import collections
+import csv
+import json
+import logging
 import os
+import shutil
+import six
 import sys
+import threading
 import time
 
-from util import ctxyaml
-
 from satori.client.common import want_import
 want_import(globals(), '*')
 
-from testing.common import copy_file, make_test_data, upload_blob
+from testing.common import download_blob, make_pool, make_test_data
+from testing.upload import BlobUploader, wait_test_data
 
 
-def _temporary_submit_internal(
-        test_pair, submit_file_path, override_time=None, store_io=False):
-    test_data = make_test_data(test_pair, True)
+def _make_temporary_test_data(
+        test_pair, override_time=None, store_io=False, uploader=None, out=None):
+    test_data = make_test_data(test_pair, True, out, uploader)
     if override_time is not None and 'time' in test_data:
         test_data['_original_time'] = test_data['time']
         test_data['time'] = AnonymousAttribute(is_blob=False, value=override_time)
     if store_io:
         test_data['store_io'] = AnonymousAttribute(is_blob=False, value='true')
+    return test_data
+
+
+def _make_submit_data(submit_file_path, uploader, out):
     if submit_file_path[:1] == '%':
         submits = Submit.filter(SubmitStruct(id=int(submit_file_path[1:])))
         if not submits:
-            raise RuntimeException("Cannot find submit " + submit_file_path)
-        submit_data = submits[0].data_get_map()
-    else:
-        submit_data = {'content': upload_blob(submit_file_path)}
-    submit = TemporarySubmit.create(test_data, submit_data)
-    print 'Testing %s on %s, temporary submit id: %d' % (
-            submit_data['content'].filename,
-            test_data['name'].value,
-            submit.id)
-    return submit
+            raise RuntimeError("Cannot find submit " + submit_file_path)
+        return submits[0].data_get_map()
+    return {'content': uploader.submit(submit_file_path, out)}
+
+
+def _create_temporary_submits(solutions, tests, override_time, store_io,
+        jobs, pool_map, out=None):
+    # Data of every test and solution is built and uploaded once, then
+    # shared by all submits using it.
+    if out is None:
+        out = sys.stdout
+    with BlobUploader(jobs) as uploader:
+        tests_data = [_make_temporary_test_data(
+                test_pair, override_time, store_io, uploader, out)
+                for test_pair in tests.items()]
+        submits_data = [_make_submit_data(submit_file_path, uploader, out)
+                for submit_file_path in solutions]
+
+        def create(data_pair):
+            (submit_data, test_data) = data_pair
+            return TemporarySubmit.create(wait_test_data(test_data),
+                    wait_test_data(submit_data))
+
+        data_pairs = [(submit_data, test_data)
+                for submit_data in submits_data for test_data in tests_data]
+        submits = pool_map(create, data_pairs)
+    runs = []
+    for ((submit_data, test_data), submit) in zip(data_pairs, submits):
+        run = _SubmitRun(submit, wait_test_data(submit_data),
+                wait_test_data(test_data))
+        print >>out, 'Testing %s on %s, temporary submit id: %d' % (
+                run.submit_map['content'].filename,
+                run.test_map['name'].value,
+                submit.id)
+        runs.append(run)
+    return runs
+
+
+class _SubmitRun(object):
+    """A temporary submit with the data it was created with and its result."""
+
+    def __init__(self, submit, submit_map, test_map):
+        self.submit = submit
+        self.submit_map = submit_map
+        self.test_map = test_map
+        self.result_map = None
+
+
+def _format_table(table):
+    widths = [max(map(len, column)) for column in zip(*table)]
+    return ['  '.join(elem.ljust(width) for (elem, width) in zip(row, widths))
+            for row in table]
 
 
 def _prettyprint_table(table):
-    widths = [max(map(len, column)) for column in zip(*table)]
-    for row in table:
-        row = [elem.ljust(width) for (elem, width) in zip(row, widths)]
-        print '  '.join(row)
+    for line in _format_table(table):
+        print line
 
 
 def _results_header():
@@ -61,103 +111,396 @@ def _get_time_limit(test_map):
         return _get_from_map(test_map, 'time')
 
 
-def _submit_to_results_row(submit):
-    test_map = submit.test_data_get_map()
-    result_map = submit.result_get_map()
+PENDING = '...'
+
+
+def _run_to_results_row(run):
+    result_map = run.result_map or {}
     result_row = []
-    result_row.append(submit.submit_data_get_map()['content'].filename)
-    result_row.append(_get_from_map(test_map, 'name'))
-    result_row.append(_get_from_map(result_map, 'status'))
-    result_row.append('%s / %s' % (
-        _get_from_map(result_map, 'execute_time_cpu'),
-        _get_time_limit(test_map)))
-    result_row.append(str(submit.id))
+    result_row.append(run.submit_map['content'].filename)
+    result_row.append(_get_from_map(run.test_map, 'name'))
+    if run.result_map is None:
+        result_row.append(PENDING)
+        result_row.append('%s / %s' % (PENDING, _get_time_limit(run.test_map)))
+    else:
+        result_row.append(_get_from_map(result_map, 'status'))
+        result_row.append('%s / %s' % (
+            _get_from_map(result_map, 'execute_time_cpu'),
+            _get_time_limit(run.test_map)))
+    result_row.append(str(run.submit.id))
     return result_row
 
 
-def _results_to_2d_table(solutions, submits):                                    
-    assert len(submits) % len(solutions) == 0                                    
-    header = ['test'] + list(solutions) + ['limit']                              
-    table = [header]                                                             
-    for i in range(0, len(submits) / len(solutions)):                            
-        row = []                                                                 
-        test_map = submits[i].test_data_get_map()                                
-        row.append(_get_from_map(test_map, 'name'))                              
-        for j in range(i, len(submits), len(submits) / len(solutions)):          
-            result_map = submits[j].result_get_map()                             
-            status = _get_from_map(result_map, 'status')                         
-            if status == 'OK':                                                   
-                status = _get_from_map(result_map, 'execute_time_cpu')           
-            row.append(status)                                                   
-        row.append(_get_time_limit(test_map))                                    
-        table.append(row)                                                        
+def _results_to_2d_table(solutions, runs):
+    assert len(runs) % len(solutions) == 0
+    tests_count = len(runs) / len(solutions)
+    header = ['test'] + list(solutions) + ['limit']
+    table = [header]
+    for i in range(0, tests_count):
+        row = []
+        test_map = runs[i].test_map
+        row.append(_get_from_map(test_map, 'name'))
+        for run in runs[i::tests_count]:
+            if run.result_map is None:
+                status = PENDING
+            else:
+                status = _get_from_map(run.result_map, 'status')
+                if status == 'OK':
+                    status = _get_from_map(run.result_map, 'execute_time_cpu')
+            row.append(status)
+        row.append(_get_time_limit(test_map))
+        table.append(row)
     return table
 
 
-def _wait_for_results(submits):
-    waiting_start = time.time()
-    total = len(submits)
-    print 'Waiting for results, %d/%d done' % (0, total),
-    sys.stdout.flush()
-    last_reported = 0
-    while True:
-        done = 0
-        for submit in submits:
-            if submit.result_get_list():
-                done += 1
-        if done >= total:
-            break
-        if done > last_reported:
-            print
-            print 'Waiting for results, %d/%d done' % (done, total),
-            sys.stdout.flush()
-            last_reported = done
-        time.sleep(2)
-        print '.',
+def _terminal_height():
+    try:
+        import fcntl, struct, termios
+        return struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(),
+            termios.TIOCGWINSZ, '1234'))[0]
+    except (ImportError, EnvironmentError, ValueError):
+        return 0
+
+
+# CPU times are given to the millisecond, as in 0.132s
+CPU_TIME_DECIMALS = '.000'
+
+
+class _ResultsStream(object):
+    """Prints the rows of the results table in submit order as submits finish.
+
+    The row of a finished submit waits for the rows of all earlier ones.
+    Column widths are computed up front, with CPU times taken to be as long
+    as their time limits given to the millisecond, and statuses no longer
+    than the header.
+    """
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.printed = 0
+        table = [_results_header()] + map(self._widest_row, runs)
+        self.widths = [max(map(len, column)) for column in zip(*table)]
+        self._print_row(_results_header())
+
+    @staticmethod
+    def _widest_row(run):
+        # only the lengths of the elements matter
+        row = _run_to_results_row(run)
+        row[2] = ''
+        row[3] = '%s%s / %s' % (_get_from_map(run.test_map, 'time'),
+                CPU_TIME_DECIMALS, _get_time_limit(run.test_map))
+        return row
+
+    def _print_row(self, row):
+        print '  '.join(elem.ljust(width) for (elem, width) in zip(row, self.widths))
+
+    def update(self, finished):
+        while self.printed < len(self.runs) and \
+                self.runs[self.printed].result_map is not None:
+            self._print_row(_run_to_results_row(self.runs[self.printed]))
+            self.printed += 1
         sys.stdout.flush()
-    waiting_time = time.time() - waiting_start
-    print
-    print 'You had to wait %ds' % int(round(waiting_time))
+
+    def close(self):
+        pass
 
 
-def _store_result_blob(result_map, blob_name, out_fname):
-    if blob_name in result_map:
-        with open(out_fname, 'w') as out_file:
-            copy_file(Blob.open(result_map[blob_name].value), out_file)
+class _Live2dTable(object):
+    """Redraws the 2D results table in place as results arrive."""
 
+    def __init__(self, solutions, runs):
+        self.solutions = solutions
+        self.runs = runs
+        self.lines = 0
+        self._draw()
 
-def _store_io(submit):                                                           
-    test_name = submit.test_data_get_map()['name'].value
-    result_map = submit.result_get_map()
-    _store_result_blob(result_map, 'input_file', test_name + '.in')
-    _store_result_blob(result_map, 'output_file', test_name + '.out')
+    @staticmethod
+    def fits(solutions, runs):
+        return sys.stdout.isatty() and \
+                len(runs) / len(solutions) + 2 < _terminal_height()
+
+    def _draw(self):
+        table = _results_to_2d_table(self.solutions, self.runs)
+        if self.lines:
+            sys.stdout.write('\033[%dA' % self.lines)
+        for line in _format_table(table):
+            sys.stdout.write(line + '\033[K\n')
+        sys.stdout.flush()
+        self.lines = len(table)
+
+    def update(self, finished):
+        self._draw()
+
+    def close(self):
+        pass
+
+
+RECORD_FIELDS = ['solution', 'test', 'status', 'cpu_time', 'time_limit',
+        'original_time_limit', 'memory_limit', 'submit_id', 'result']
+
+
+def _get_value(attr_map, attr):
+    if attr in attr_map:
+        return attr_map[attr].value
+    return None
+
+
+def _run_to_record(run):
+    result_map = run.result_map or {}
+    return {
+        'solution': run.submit_map['content'].filename,
+        'test': _get_value(run.test_map, 'name'),
+        'status': _get_value(result_map, 'status'),
+        'cpu_time': _get_value(result_map, 'execute_time_cpu'),
+        'time_limit': _get_value(run.test_map, 'time'),
+        'original_time_limit': _get_value(run.test_map, '_original_time'),
+        'memory_limit': _get_value(run.test_map, 'memory'),
+        'submit_id': run.submit.id,
+        'result': dict((name, attr.value)
+            for (name, attr) in result_map.items() if not attr.is_blob),
+    }
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        value = json.dumps(value, sort_keys=True)
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+class _RecordStream(object):
+    """Writes a JSON Lines or CSV record of every submit once it finishes.
+
+    Scalar result attributes are gathered in the 'result' field, which CSV
+    records hold as a JSON object.
+    """
+
+    def __init__(self, format, out=None):
+        if out is None:
+            out = sys.stdout
+        self.format = format
+        self.out = out
+        if format == 'csv':
+            self.writer = csv.writer(out)
+            self.writer.writerow(RECORD_FIELDS)
+
+    def update(self, finished):
+        for run in finished:
+            record = _run_to_record(run)
+            if self.format == 'jsonl':
+                self.out.write(json.dumps(record, sort_keys=True) + '\n')
+            else:
+                self.writer.writerow([_csv_value(record[field])
+                    for field in RECORD_FIELDS])
+        self.out.flush()
+
+    def close(self):
+        pass
+
+
+POLL_INTERVAL_MIN = 0.5
+POLL_INTERVAL_MAX = 10
+
+
+def _wait_for_results(runs, pool_map=map, view=None, on_finished=None,
+        out=None):
+    """Waits for results of all runs and stores them in the runs.
+
+    Only submits still pending are checked again. Their results are
+    fetched in one pipelined batch, or concurrently with pool_map if the
+    client cannot pipeline calls. Checks get less frequent while no new
+    results arrive. The server offers no way to wait for a result, so
+    polling is unavoidable. Finished runs are passed to the view, if any,
+    instead of printing the progress, and to on_finished.
+    """
+    if out is None:
+        out = sys.stdout
+    waiting_start = time.time()
+    total = len(runs)
+    if view is None:
+        print >>out, 'Waiting for results, %d/%d done' % (0, total),
+        out.flush()
+    pending = list(runs)
+    interval = POLL_INTERVAL_MIN
+    while True:
+        result_maps = TemporarySubmit.result_get_map.call_many(
+                [(run.submit,) for run in pending], pool_map)
+        finished = []
+        still_pending = []
+        for (run, result_map) in zip(pending, result_maps):
+            if result_map:
+                run.result_map = result_map
+                finished.append(run)
+            else:
+                still_pending.append(run)
+        if finished and view is not None:
+            view.update(finished)
+        if finished and on_finished is not None:
+            on_finished(finished)
+        if not still_pending:
+            break
+        if finished:
+            if view is None:
+                print >>out
+                print >>out, 'Waiting for results, %d/%d done' % (total - len(still_pending), total),
+            interval = POLL_INTERVAL_MIN
+        else:
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+        pending = still_pending
+        out.flush()
+        time.sleep(interval)
+        if view is None:
+            print >>out, '.',
+            out.flush()
+    if view is not None:
+        view.close()
+    waiting_time = time.time() - waiting_start
+    if view is None:
+        print >>out
+    print >>out, 'You had to wait %ds' % int(round(waiting_time))
+
+
+def _link_file(source, path):
+    """Replaces path with a hard link to source, or a copy of it.
+
+    The new file is created under a temporary name and renamed over path,
+    so path is never left missing. Returns whether path is a link.
+    """
+    temporary = path + '.link'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    try:
+        os.link(source, temporary)
+        linked = True
+    except (AttributeError, OSError):
+        try:
+            shutil.copyfile(source, temporary)
+        except EnvironmentError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        linked = False
+    os.rename(temporary, path)
+    return linked
+
+
+class _IoStore(object):
+    """Stores input and output files of finished submits in the background.
+
+    Every distinct BLOB is downloaded once and other files with the same
+    content are hard links to it. Submits for the same test store files
+    under the same names, so writes to each file are serialized.
+    """
+
+    def __init__(self, jobs):
+        # BLOBs are downloaded over HTTP
+        self._pool = make_pool(jobs, calls=False)
+        self._lock = threading.Lock()
+        self._locks = collections.defaultdict(threading.Lock)
+        self._stored = {}
+        self._sources = {}
+        self._results = []
+
+    def _named_lock(self, name):
+        with self._lock:
+            return self._locks[name]
+
+    def add(self, finished):
+        for run in finished:
+            test_name = run.test_map['name'].value
+            for (blob_name, suffix) in [('input_file', '.in'), ('output_file', '.out')]:
+                if blob_name in run.result_map:
+                    self._results.append(self._pool.apply_async(self._store,
+                        (run.result_map[blob_name].value, test_name + suffix)))
+
+    def _store(self, blob_hash, path):
+        # path locks are always taken before hash locks
+        with self._named_lock(('path', path)):
+            with self._named_lock(('hash', blob_hash)):
+                with self._lock:
+                    previous = self._stored.get(path)
+                    if previous == blob_hash:
+                        return
+                    # the file is about to be replaced, so it cannot be
+                    # the source of its previous BLOB anymore
+                    if previous is not None and \
+                            self._sources.get(previous, (None,))[0] == path:
+                        del self._sources[previous]
+                    self._stored.pop(path, None)
+                    source = self._sources.get(blob_hash)
+                if source is not None:
+                    (source_path, source_inode) = source
+                    try:
+                        # the source may have been replaced since it was stored
+                        if source_path == path or \
+                                not _link_file(source_path, path) or \
+                                os.stat(path).st_ino != source_inode:
+                            source = None
+                    except EnvironmentError:
+                        logging.debug('Failed to link %s to %s', path,
+                                source_path, exc_info=True)
+                        source = None
+                if source is None:
+                    download_blob(blob_hash, path)
+                with self._lock:
+                    self._stored[path] = blob_hash
+                    self._sources[blob_hash] = (path, os.stat(path).st_ino)
+
+    def close(self):
+        """Waits for all files to be stored."""
+        self._pool.close()
+        self._pool.join()
+        for result in self._results:
+            result.get()
+
+    def terminate(self):
+        self._pool.terminate()
 
 
 def temporary_submit(opts):
+    from util import ctxyaml
+
     with open(opts.TESTSUITE) as tests_file:
         tests = ctxyaml.load(tests_file)
     
-    submits = []
-    for submit_file_path in opts.SOLUTIONS:
-        for test_pair in tests.items():
-            submit = _temporary_submit_internal(
-                    test_pair, submit_file_path, opts.time, opts.store_io)
-            submits.append(submit)
-
-    _wait_for_results(submits)
-    if not opts.verbose:
-        if opts.results2d:                  
-            table = _results_to_2d_table(opts.SOLUTIONS, submits)
-        else:
-            table = [_results_header()] + map(_submit_to_results_row, submits)
-        _prettyprint_table(table)
-    else:
-        for submit in submits:
-            print '=' * 70
-            _verbose_result_internal(submit, opts.length_limit)
-    if opts.store_io:
-        for submit in submits:
-            _store_io(submit)
+    pool = make_pool(opts.jobs) if opts.jobs > 1 else None
+    pool_map = pool.map if pool else map
+    # input and output files are downloaded while waiting for other results
+    io_store = _IoStore(opts.jobs) if opts.store_io else None
+    # records are the only output on stdout, progress goes to stderr
+    out = sys.stdout if opts.format == 'text' else sys.stderr
+    try:
+        runs = _create_temporary_submits(opts.SOLUTIONS, tests, opts.time,
+                opts.store_io, opts.jobs, pool_map, out)
+        view = None
+        if opts.format != 'text':
+            view = _RecordStream(opts.format)
+        elif opts.verbose:
+            pass
+        elif not opts.results2d:
+            view = _ResultsStream(runs)
+        elif _Live2dTable.fits(opts.SOLUTIONS, runs):
+            view = _Live2dTable(opts.SOLUTIONS, runs)
+        _wait_for_results(runs, pool_map, view,
+                io_store.add if io_store is not None else None, out)
+        if opts.format != 'text':
+            pass
+        elif opts.verbose:
+            for run in runs:
+                print '=' * 70
+                _verbose_result_internal(run.submit, opts.length_limit)
+        elif view is None:
+            _prettyprint_table(_results_to_2d_table(opts.SOLUTIONS, runs))
+        if io_store is not None:
+            io_store.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if io_store is not None:
+            io_store.terminate()
 
 
 def _print_bold_caption(caption):
@@ -192,4 +535,10 @@ def verbose_result(opts):
     if not submit:
         raise RuntimeError('Unknown temporary submit id')
     submit = submit[0]
+    if opts.format != 'text':
+        run = _SubmitRun(submit, submit.submit_data_get_map(),
+                submit.test_data_get_map())
+        run.result_map = submit.result_get_map() or None
+        _RecordStream(opts.format).update([run])
+        return
     _verbose_result_internal(submit, opts.length_limit)
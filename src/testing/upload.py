@@ -0,0 +1,160 @@
+# vim:ts=4:sts=4:sw=4:et
+import os
+import sys
+import threading
+from six.moves import queue
+
+from satori.ars.futures import Future
+
+from satori.client.common import want_import
+want_import(globals(), '*')
+
+from testing.common import _calculate_blob_hash, make_pool, missing_blobs, \
+        remember_blobs, upload_file
+
+
+DEFAULT_MAX_IN_FLIGHT = 256 * 1024 * 1024
+EXISTS_BATCH_SIZE = 64
+
+
+class ByteBudget(object):
+    """Limits the number of bytes transferred at the same time."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        # a single BLOB larger than the whole budget is let through alone
+        size = min(size, self.limit)
+        with self._condition:
+            while self.used + size > self.limit:
+                self._condition.wait()
+            self.used += size
+        return size
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class BlobUploader(object):
+    """Uploads BLOBs in a pipeline running in the background.
+
+    Hashing workers feed an existence check stage, which passes BLOBs
+    missing on the server to a pool of uploaders. Every stage runs
+    concurrently with the others and with the caller, who gets a Future
+    for each BLOB. Every distinct BLOB is checked and uploaded only once.
+
+    Existence checks are collected into batches of pipelined calls.
+    BLOBs known to be stored on the server are not checked, unless verify
+    is set.
+    """
+
+    def __init__(self, jobs=4, max_in_flight=DEFAULT_MAX_IN_FLIGHT, verify=False):
+        self._budget = ByteBudget(max_in_flight)
+        self._verify = verify
+        # BLOBs are hashed locally and uploaded over HTTP
+        self._hash_pool = make_pool(jobs, calls=False)
+        self._upload_pool = make_pool(jobs, calls=False)
+        self._check_pool = make_pool(1)
+        self._check_queue = queue.Queue()
+        self._blobs = {}
+        self._lock = threading.Lock()
+        self._check_pool.apply_async(self._check_loop)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Waits for all scheduled BLOBs and stops the workers."""
+        self._hash_pool.close()
+        self._hash_pool.join()
+        self._check_queue.put(None)
+        self._check_pool.close()
+        self._check_pool.join()
+        self._upload_pool.close()
+        self._upload_pool.join()
+
+    def submit(self, blob_path, out):
+        """Schedules upload of a file.
+
+        Returns a Future of the AnonymousAttribute referencing the BLOB.
+        """
+        future = Future()
+        self._hash_pool.apply_async(self._hash, (blob_path, out, future))
+        return future
+
+    def _hash(self, blob_path, out, future):
+        try:
+            blob_hash = _calculate_blob_hash(blob_path)
+            blob_name = os.path.basename(blob_path)
+            with self._lock:
+                stored = self._blobs.get(blob_hash)
+                if stored is None:
+                    stored = self._blobs[blob_hash] = Future()
+                    self._check_queue.put((blob_hash, blob_path, out, stored))
+            future.chain(stored.then(lambda blob_hash: AnonymousAttribute(
+                is_blob=True, value=blob_hash, filename=blob_name)))
+        except:
+            future.set_exception()
+
+    def _check_loop(self):
+        while True:
+            item = self._check_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < EXISTS_BATCH_SIZE:
+                try:
+                    item = self._check_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._check_queue.put(None)
+                    break
+                batch.append(item)
+            self._check(batch)
+
+    def _check(self, batch):
+        try:
+            missing = missing_blobs([item[0] for item in batch], not self._verify)
+        except:
+            exc_info = sys.exc_info()
+            for (blob_hash, blob_path, out, stored) in batch:
+                stored.set_exception(exc_info)
+            return
+        for (blob_hash, blob_path, out, stored) in batch:
+            if blob_hash in missing:
+                self._upload_pool.apply_async(self._upload,
+                        (blob_hash, blob_path, out, stored))
+            else:
+                stored.set_result(blob_hash)
+
+    def _upload(self, blob_hash, blob_path, out, stored):
+        try:
+            blob_size = os.path.getsize(blob_path)
+            reserved = self._budget.acquire(blob_size)
+            try:
+                remote_blob_hash = upload_file(blob_path)
+            finally:
+                self._budget.release(reserved)
+            if remote_blob_hash != blob_hash:
+                raise RuntimeError('Hash mismatch after uploading %s' % blob_path)
+            remember_blobs([blob_hash])
+            out.write('Uploading blob %s, size = %d bytes... done\n' % (
+                os.path.basename(blob_path), blob_size))
+            stored.set_result(blob_hash)
+        except:
+            stored.set_exception()
+
+
+def wait_test_data(test_data):
+    """Replaces Futures in test data returned by make_test_data with their results."""
+    return dict((key, value.result() if isinstance(value, Future) else value)
+            for (key, value) in test_data.items())
@@ -18,7 +18,17 @@
 #
 
 from TProtocol import *
-from struct import pack, unpack
+from struct import Struct
+
+# precompiled, so that the format is not looked up on every call
+_BYTE = Struct('!b')
+_I16 = Struct('!h')
+_I32 = Struct('!i')
+_I64 = Struct('!q')
+_DOUBLE = Struct('!d')
+_FIELD = Struct('!bh')
+_LIST = Struct('!bi')
+_MAP = Struct('!bbi')
 
 
 class TBinaryProtocol(TProtocolBase):
@@ -43,13 +53,11 @@ class TBinaryProtocol(TProtocolBase):
 
   def writeMessageBegin(self, name, type, seqid):
     if self.strictWrite:
-      self.writeI32(TBinaryProtocol.VERSION_1 | type)
-      self.writeString(name)
-      self.writeI32(seqid)
+      self.trans.write(_I32.pack(TBinaryProtocol.VERSION_1 | type) +
+                       _I32.pack(len(name)) + name + _I32.pack(seqid))
     else:
-      self.writeString(name)
-      self.writeByte(type)
-      self.writeI32(seqid)
+      self.trans.write(_I32.pack(len(name)) + name + _BYTE.pack(type) +
+                       _I32.pack(seqid))
 
   def writeMessageEnd(self):
     pass
@@ -61,8 +69,7 @@ class TBinaryProtocol(TProtocolBase):
     pass
 
   def writeFieldBegin(self, name, type, id):
-    self.writeByte(type)
-    self.writeI16(id)
+    self.trans.write(_FIELD.pack(type, id))
 
   def writeFieldEnd(self):
     pass
@@ -71,55 +78,46 @@ class TBinaryProtocol(TProtocolBase):
     self.writeByte(TType.STOP)
 
   def writeMapBegin(self, ktype, vtype, size):
-    self.writeByte(ktype)
-    self.writeByte(vtype)
-    self.writeI32(size)
+    self.trans.write(_MAP.pack(ktype, vtype, size))
 
   def writeMapEnd(self):
     pass
 
   def writeListBegin(self, etype, size):
-    self.writeByte(etype)
-    self.writeI32(size)
+    self.trans.write(_LIST.pack(etype, size))
 
   def writeListEnd(self):
     pass
 
   def writeSetBegin(self, etype, size):
-    self.writeByte(etype)
-    self.writeI32(size)
+    self.trans.write(_LIST.pack(etype, size))
 
   def writeSetEnd(self):
     pass
 
   def writeBool(self, bool):
     if bool:
-      self.writeByte(1)
+      self.trans.write('\x01')
     else:
-      self.writeByte(0)
+      self.trans.write('\x00')
 
   def writeByte(self, byte):
-    buff = pack("!b", byte)
-    self.trans.write(buff)
+    self.trans.write(_BYTE.pack(byte))
 
   def writeI16(self, i16):
-    buff = pack("!h", i16)
-    self.trans.write(buff)
+    self.trans.write(_I16.pack(i16))
 
   def writeI32(self, i32):
-    buff = pack("!i", i32)
-    self.trans.write(buff)
+    self.trans.write(_I32.pack(i32))
 
   def writeI64(self, i64):
-    buff = pack("!q", i64)
-    self.trans.write(buff)
+    self.trans.write(_I64.pack(i64))
 
   def writeDouble(self, dub):
-    buff = pack("!d", dub)
-    self.trans.write(buff)
+    self.trans.write(_DOUBLE.pack(dub))
 
   def writeString(self, str):
-    self.writeI32(len(str))
+    self.trans.write(_I32.pack(len(str)))
     self.trans.write(str)
 
   def readMessageBegin(self):
@@ -152,73 +150,58 @@ class TBinaryProtocol(TProtocolBase):
     pass
 
   def readFieldBegin(self):
-    type = self.readByte()
+    type, = _BYTE.unpack(self.trans.readAll(1))
     if type == TType.STOP:
       return (None, type, 0)
-    id = self.readI16()
+    id, = _I16.unpack(self.trans.readAll(2))
     return (None, type, id)
 
   def readFieldEnd(self):
     pass
 
   def readMapBegin(self):
-    ktype = self.readByte()
-    vtype = self.readByte()
-    size = self.readI32()
-    return (ktype, vtype, size)
+    return _MAP.unpack(self.trans.readAll(6))
 
   def readMapEnd(self):
     pass
 
   def readListBegin(self):
-    etype = self.readByte()
-    size = self.readI32()
-    return (etype, size)
+    return _LIST.unpack(self.trans.readAll(5))
 
   def readListEnd(self):
     pass
 
   def readSetBegin(self):
-    etype = self.readByte()
-    size = self.readI32()
-    return (etype, size)
+    return _LIST.unpack(self.trans.readAll(5))
 
   def readSetEnd(self):
     pass
 
   def readBool(self):
-    byte = self.readByte()
-    if byte == 0:
-      return False
-    return True
+    return self.trans.readAll(1) != '\x00'
 
   def readByte(self):
-    buff = self.trans.readAll(1)
-    val, = unpack('!b', buff)
+    val, = _BYTE.unpack(self.trans.readAll(1))
     return val
 
   def readI16(self):
-    buff = self.trans.readAll(2)
-    val, = unpack('!h', buff)
+    val, = _I16.unpack(self.trans.readAll(2))
     return val
 
   def readI32(self):
-    buff = self.trans.readAll(4)
-    val, = unpack('!i', buff)
+    val, = _I32.unpack(self.trans.readAll(4))
     return val
 
   def readI64(self):
-    buff = self.trans.readAll(8)
-    val, = unpack('!q', buff)
+    val, = _I64.unpack(self.trans.readAll(8))
     return val
 
   def readDouble(self):
-    buff = self.trans.readAll(8)
-    val, = unpack('!d', buff)
+    val, = _DOUBLE.unpack(self.trans.readAll(8))
     return val
 
   def readString(self):
-    len = self.readI32()
+    len, = _I32.unpack(self.trans.readAll(4))
     str = self.trans.readAll(len)
     return str
 
@@ -52,17 +52,18 @@ class TTransportBase:
     pass
 
   def readAll(self, sz):
-    buff = ''
+    # chunks are joined once, instead of copying the buffer on every read
+    chunks = []
     have = 0
     while (have < sz):
       chunk = self.read(sz - have)
       have += len(chunk)
-      buff += chunk
+      chunks.append(chunk)
 
       if len(chunk) == 0:
         raise EOFError()
 
-    return buff
+    return ''.join(chunks)
 
   def write(self, buf):
     pass
@@ -159,6 +160,13 @@ class TBufferedTransport(TTransportBase, CReadableTransport):
     self.__rbuf = StringIO(self.__trans.read(max(sz, self.__rbuf_size)))
     return self.__rbuf.read(sz)
 
+  def readAll(self, sz):
+    # most reads are served from the buffer at once
+    ret = self.__rbuf.read(sz)
+    if len(ret) == sz:
+      return ret
+    return ret + TTransportBase.readAll(self, sz - len(ret))
+
   def write(self, buf):
     self.__wbuf.write(buf)
 
@@ -271,6 +279,13 @@ class TFramedTransport(TTransportBase, CReadableTransport):
     self.readFrame()
     return self.__rbuf.read(sz)
 
+  def readAll(self, sz):
+    # most reads are served from the current frame at once
+    ret = self.__rbuf.read(sz)
+    if len(ret) == sz:
+      return ret
+    return ret + TTransportBase.readAll(self, sz - len(ret))
+
   def readFrame(self):
     buff = self.__trans.readAll(4)
     sz, = unpack('!i', buff)
@@ -1,11 +1,11 @@
+import binascii
 import hashlib
 import io
 import os
 import shutil
 import tempfile
 
-from util.ctxyaml import scalars
-from util import paths
+from util import hashcache, paths
 
 
 class BlobState(object):
@@ -21,14 +21,18 @@ class BlobStateException(Exception):
     pass
 
 
+def file_digest(path):
+    digest = binascii.hexlify(hashcache.file_digests(path, [ 'sha1' ])[0])
+    return digest if isinstance(digest, str) else digest.decode()
+
+
 class Blob(object):
 
     def __init__(self, path=None, basename=None, content=None, digest=None):
         self.path = path
         self.basename = basename or (path and os.path.basename(path))
         if self.path:
-            with io.open(self.path, 'rb') as stream:
-                self.digest = hashlib.sha1(stream.read()).hexdigest()
+            self.digest = file_digest(self.path)
             self.content = None
             self.state = BlobState.HASFILE
         elif content:
@@ -49,8 +53,7 @@ class Blob(object):
             if self.digest:
                 self.acquire()
             elif self.path:
-                with io.open(self.path, 'rb') as stream:
-                    self.digest = hashlib.sha1(stream.read()).hexdigest()
+                self.digest = file_digest(self.path)
                 self.content = None
                 self.state = BlobState.HASFILE
 
@@ -91,8 +94,7 @@ class Blob(object):
                 self.acquire()
             elif self.path:
                 if 'r' in mode and '+' not in mode:
-                    with io.open(self.path, 'rb') as stream:
-                        self.digest = hashlib.sha1(stream.read()).hexdigest()
+                    self.digest = file_digest(self.path)
                     self.state = BlobState.HASFILE
                     return io.open(self.path, mode, **kwargs)
                 else:
@@ -100,8 +102,7 @@ class Blob(object):
                     old_close = stream.close
                     def close():
                         old_close()
-                        with io.open(self.path, 'rb') as stream:
-                            self.digest = hashlib.sha1(stream.read()).hexdigest()
+                        self.digest = file_digest(self.path)
                         self.state = BlobState.HASFILE
                     stream.close = close
                     self.content = None
@@ -213,11 +214,3 @@ def dump_blob(value, context):
     else:
         value.release()
         return dict(hash=value.digest, name=value.basename)
-
-scalars.register(
-    scalars.Scalar,
-    type=Blob,
-    tag='!file',
-    load=load_blob,
-    dump=dump_blob
-)
@@ -1,3 +1,4 @@
+import io
 import os
 import sys
 import yaml
@@ -8,18 +9,24 @@ from util.ctxyaml.context import Context, WithContext
 __all__ = [ 'HUMAN', 'MACHINE', 'load', 'load_all', 'dump', 'dump_all' ]
 
 
-class Loader(yaml.SafeLoader, WithContext):
+# libyaml parses and emits, when present; constructors, representers and
+# resolvers are the same for both
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+class Loader(WithContext, _SafeLoader):
     pass
 
 
-class Dumper(yaml.SafeDumper, WithContext):
-    def __init__(self, *args, **kwargs):
+class Dumper(WithContext, _SafeDumper):
+    def __init__(self, stream, context, **kwargs):
         kwargs['allow_unicode'] = True
         kwargs['width'] = sys.maxsize
-        kwargs['indent'] = self.context.indent
-        kwargs['default_style'] = self.context.default_style
-        kwargs['default_flow_style'] = self.context.default_flow_style
-        super(Dumper, self).__init__(*args, **kwargs)
+        kwargs['indent'] = context.indent
+        kwargs['default_style'] = context.default_style
+        kwargs['default_flow_style'] = context.default_flow_style
+        super(Dumper, self).__init__(stream, context, **kwargs)
 
 for c in "0123456789":
     Dumper.yaml_implicit_resolvers[c] = [ ( t, r ) for ( t, r ) in Dumper.yaml_implicit_resolvers[c] if t != 'tag:yaml.org,2002:timestamp' ]
@@ -42,19 +49,39 @@ MACHINE = Context(
 
 def load(source, context=HUMAN, **kwargs):
     ctx = context.apply(current_dir=paths.directory_of(source), **kwargs).defaults(root_dir=os.getcwd())
-    return yaml.load(source, Loader.create_class(ctx))
+    loader = Loader.for_context(ctx)(source, ctx)
+    try:
+        return loader.get_single_data()
+    finally:
+        loader.dispose()
 
 def load_all(source, context=HUMAN, **kwargs):
     ctx = context.apply(current_dir=paths.directory_of(source), **kwargs).defaults(root_dir=os.getcwd())
-    return yaml.load_all(source, Loader.create_class(ctx))
+    loader = Loader.for_context(ctx)(source, ctx)
+    try:
+        while loader.check_data():
+            yield loader.get_data()
+    finally:
+        loader.dispose()
 
 def dump(value, target=None, context=HUMAN, **kwargs):
-    ctx = context.apply(current_dir=paths.directory_of(target), **kwargs).defaults(root_dir=os.getcwd())
-    return yaml.dump(value, target, Dumper.create_class(ctx))
+    return dump_all([ value ], target, context, **kwargs)
 
 def dump_all(values, target=None, context=HUMAN, **kwargs):
     ctx = context.apply(current_dir=paths.directory_of(target), **kwargs).defaults(root_dir=os.getcwd())
-    return yaml.dump_all(values, target, Dumper.create_class(ctx))
+    stream = target
+    if target is None:
+        stream = io.BytesIO()
+    dumper = Dumper.for_context(ctx)(stream, ctx, encoding='utf-8')
+    try:
+        dumper.open()
+        for value in values:
+            dumper.represent(value)
+        dumper.close()
+    finally:
+        dumper.dispose()
+    if target is None:
+        return stream.getvalue()
 
 
 import util.ctxyaml.include
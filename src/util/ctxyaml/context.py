@@ -14,14 +14,26 @@ class Context(object):
         result.__dict__.update(kwargs)
         return result
 
+_classes = { }
+
 class WithContext(object):
+    """Base of loaders and dumpers, which get the context as an argument."""
+    def __init__(self, stream, context, **kwargs):
+        self.context = context
+        super(WithContext, self).__init__(stream, **kwargs)
     @classmethod
-    def create_class(cls, context):
-        class Target(cls):
-            def __init__(self, *args, **kwargs):
-                self.context = context
-                super(Target, self).__init__(*args, **kwargs)
-        Target.__name__ = cls.__name__
-        for tag, regex in getattr(context, 'resolvers', { }).items():
-            Target.add_implicit_resolver(tag, regex, None)
-        return Target
+    def for_context(cls, context):
+        """Returns the subclass with the implicit resolvers of the context.
+
+        Subclasses are created once for each set of resolvers, as contexts
+        differ in paths for every loaded file.
+        """
+        resolvers = getattr(context, 'resolvers', { })
+        key = (cls, frozenset(resolvers.items()))
+        target = _classes.get(key)
+        if target is None:
+            target = type(cls.__name__, (cls,), { })
+            for tag, regex in resolvers.items():
+                target.add_implicit_resolver(tag, regex, None)
+            _classes[key] = target
+        return target
@@ -3,6 +3,7 @@ import datetime
 import re
 import yaml
 
+from util.blob import Blob, load_blob, dump_blob
 from util.ctxyaml import Loader, Dumper, HUMAN
 
 __all__ = [ 'Scalar', 'Implicit', 'RegexLoad', 'register' ]
@@ -104,3 +105,14 @@ register(
     regex_load=load_timespan,
     dump=dump_timespan
 )
+
+
+# registered here rather than in util.blob, so that using BLOBs does not
+# require loading yaml
+register(
+    Scalar,
+    type=Blob,
+    tag='!file',
+    load=load_blob,
+    dump=dump_blob
+)
@@ -0,0 +1,134 @@
+import logging
+import os
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from util import hashing, paths
+
+__all__ = [ 'SharedDatabase', 'HashCache', 'file_identity', 'file_digests' ]
+
+
+# digests computed together whenever a file has to be read anyway
+DEFAULT_ALGORITHMS = ( 'sha1', 'sha384' )
+
+# files modified this recently may still change within the same mtime tick
+RACY_INTERVAL = 2
+
+
+def file_identity(path):
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 10**9)
+    return ( path, stat.st_size, mtime_ns, stat.st_ino )
+
+
+class SharedDatabase(object):
+    """An SQLite database shared by all threads and processes.
+
+    Every thread uses its own connection. The database is created with the
+    given schema on first use.
+    """
+
+    schema = ''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    if not os.path.isdir(directory):
+                        raise
+            connection = sqlite3.connect(self.path, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(self.schema)
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+
+class HashCache(SharedDatabase):
+    """Persistent map from file identity to the digests of its content.
+
+    A file is identified by its path, size, modification time and inode, so
+    a cached digest is returned only for a file that was not modified since.
+    """
+
+    schema = '''CREATE TABLE IF NOT EXISTS hashes (
+        path TEXT NOT NULL,
+        algorithm TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        digest BLOB NOT NULL,
+        PRIMARY KEY (path, algorithm))'''
+
+    def get(self, identity, algorithms):
+        ( path, size, mtime_ns, inode ) = identity
+        rows = self._connection().execute(
+            'SELECT algorithm, digest FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?',
+            ( path, size, mtime_ns, inode )).fetchall()
+        return dict(( str(algorithm), bytes(digest) ) for ( algorithm, digest ) in rows if algorithm in algorithms)
+
+    def put(self, identity, digests):
+        ( path, size, mtime_ns, inode ) = identity
+        if mtime_ns > (time.time() - RACY_INTERVAL) * 10**9:
+            return
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO hashes (path, algorithm, size, mtime_ns, inode, digest) VALUES (?, ?, ?, ?, ?, ?)',
+                [ ( path, algorithm, size, mtime_ns, inode, sqlite3.Binary(digest) ) for ( algorithm, digest ) in digests.items() ])
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None and sqlite3 is not None:
+            _default_cache = HashCache(paths.cache_path('hashes.sqlite'))
+    return _default_cache
+
+
+def file_digests(path, algorithms, cache=None):
+    """Raw digests of a file's content, in the order of algorithms.
+
+    Digests are served from the cache while the file stays unmodified. On a
+    miss the file is read once for all requested and default algorithms.
+    """
+    if cache is None:
+        cache = default_cache()
+    identity = file_identity(path)
+    digests = { }
+    if cache is not None:
+        try:
+            digests = cache.get(identity, algorithms)
+        except (sqlite3.Error, EnvironmentError):
+            logging.debug('Hash cache lookup failed for %s', path, exc_info=True)
+    missing = [ algorithm for algorithm in algorithms if algorithm not in digests ]
+    if missing:
+        computed = list(missing) + [ algorithm for algorithm in DEFAULT_ALGORITHMS if algorithm not in missing ]
+        hashes = hashing.hash_file(identity[0], computed)
+        new_digests = dict(( algorithm, hash.digest() ) for ( algorithm, hash ) in zip(computed, hashes))
+        digests.update(new_digests)
+        if cache is not None and file_identity(path) == identity:
+            try:
+                cache.put(identity, new_digests)
+            except (sqlite3.Error, EnvironmentError):
+                logging.debug('Hash cache update failed for %s', path, exc_info=True)
+    return [ digests[algorithm] for algorithm in algorithms ]
@@ -0,0 +1,63 @@
+import hashlib
+import io
+import mmap
+import os
+
+__all__ = [ 'BUFFER_SIZE', 'MMAP_THRESHOLD', 'hash_stream', 'hash_file' ]
+
+
+BUFFER_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+
+def hash_stream(stream, algorithms, buffer_size=BUFFER_SIZE):
+    """Hash a stream with every algorithm, holding at most buffer_size bytes."""
+    hashes = [ hashlib.new(algorithm) for algorithm in algorithms ]
+    while True:
+        buf = stream.read(buffer_size)
+        if not buf:
+            break
+        for hash in hashes:
+            hash.update(buf)
+    return hashes
+
+
+def _hash_mapped(stream, size, algorithms, buffer_size):
+    hashes = [ hashlib.new(algorithm) for algorithm in algorithms ]
+    mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        try:
+            view = memoryview(mapped)
+        except TypeError:
+            # Python 2 mmap objects only support the old buffer interface
+            for offset in range(0, size, buffer_size):
+                chunk = buffer(mapped, offset, buffer_size)
+                for hash in hashes:
+                    hash.update(chunk)
+        else:
+            for offset in range(0, size, buffer_size):
+                chunk = view[offset:offset + buffer_size]
+                for hash in hashes:
+                    hash.update(chunk)
+                chunk.release()
+            view.release()
+    finally:
+        mapped.close()
+    return hashes
+
+
+def hash_file(path, algorithms, buffer_size=BUFFER_SIZE, mmap_threshold=MMAP_THRESHOLD):
+    """Hash a file with every algorithm in a single pass over its content.
+
+    Files of at least mmap_threshold bytes are memory-mapped instead of read,
+    which saves copying them through Python strings. Returns hash objects in
+    the order of algorithms.
+    """
+    with io.open(path, 'rb') as stream:
+        size = os.fstat(stream.fileno()).st_size
+        if mmap_threshold is not None and size and size >= mmap_threshold:
+            try:
+                return _hash_mapped(stream, size, algorithms, buffer_size)
+            except (EnvironmentError, ValueError):
+                stream.seek(0)
+        return hash_stream(stream, algorithms, buffer_size)
@@ -1,7 +1,7 @@
 import glob
 import os
 
-__all__ = [ 'directory_of', 'combine' ]
+__all__ = [ 'directory_of', 'combine', 'cache_path' ]
 
 
 def directory_of(file):
@@ -25,3 +25,12 @@ def combine(root_dir, current_dir, path):
         raise Exception("path %s is ambiguous" % path)
     path = matches[0]
     return path
+
+
+def cache_path(*names):
+    """Path of a file in the per-user cache directory of satori-problems.
+
+    All state the tool keeps between runs is stored there.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'satori-problems', *names)
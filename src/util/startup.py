@@ -0,0 +1,63 @@
+"""Measures the cold start time of the command line tool.
+
+Run with: python -m util.startup [path] [limit_ms]
+
+Each run imports the tool in a new interpreter from path, which is the
+bundle built by build.sh or the source tree by default. Exits with status 1
+when the best run is slower than limit_ms, or when modules that should be
+imported lazily are loaded at start.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import subprocess
+import sys
+import time
+
+RUNS = 10
+
+DEFAULT_LIMIT_MS = 100
+
+LAZY_MODULES = ['pkg_resources', 'ply', 'yaml', 'util.ctxyaml']
+
+_CHILD = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import testing
+print(' '.join(name for name in sys.argv[2:] if name in sys.modules))
+'''
+
+
+def _run(path):
+    start = time.time()
+    output = subprocess.check_output([sys.executable, '-c', _CHILD, path] + LAZY_MODULES)
+    return (time.time() - start, output.split())
+
+
+def main():
+    path = os.path.abspath(sys.argv[1]) if len(sys.argv) > 1 else os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    limit = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_LIMIT_MS
+
+    # writes the bytecode when run from the source tree
+    _run(path)
+    times = []
+    for i in range(RUNS):
+        (elapsed, loaded) = _run(path)
+        times.append(elapsed * 1000)
+    times.sort()
+    print('Start from {0}, {1} runs: best {2:.1f} ms, median {3:.1f} ms, limit {4:.1f} ms'.format(
+        path, RUNS, times[0], times[RUNS // 2], limit))
+
+    failed = False
+    if loaded:
+        print('Modules loaded at start: {0}'.format(', '.join(loaded)))
+        failed = True
+    if times[0] > limit:
+        print('Start is slower than the limit')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,6 @@ import os
 import sys
 import time
 
-from util import ctxyaml
-
 from satori.client.common import want_import
 want_import(globals(), '*')
 
@@ -32,7 +30,15 @@ def map_has_changed(local_map, remote_map):
     return False
   
 
+def sync_options(parser):
+    # this build syncs problems one by one, without a local manifest and
+    # without the upload pipeline, so the sync command has no options
+    pass
+
+
 def sync(opts):
+    from util import ctxyaml
+
     with open(opts.MAPPING) as mapping_file:
         mapping = ctxyaml.load(mapping_file)
 